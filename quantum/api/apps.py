@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        # Connect the signals invalidating the topology cache.
+        from . import topology  # noqa: F401
+        # Register the system checks.
+        from . import checks  # noqa: F401
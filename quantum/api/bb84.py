@@ -1,19 +1,118 @@
-from qiskit import QuantumCircuit, transpile
-import qiskit_aer as qe
+import threading
+
+from django.conf import settings
 import numpy as np
-from rest_framework import status
-from rest_framework.response import Response
 
-from .models import KeyMaterial
+# Aer simulator of this process, created on first use: Qiskit and Aer are only imported
+# by the processes running a qiskit engine.
+_simulator = None
+_simulator_lock = threading.Lock()
+# Noise models of this process, by (depolarizing, readout) probabilities.
+_noise_models = {}
 
 
-def generate_bb84_keys(num_keys, num_bits_per_key):
-    """Generate multiple keys using the BB84 protocol"""
-    all_keys = []
+def get_simulator():
+    """Retrieve the qasm_simulator backend of this process, importing Aer on first use."""
+    global _simulator
+    with _simulator_lock:
+        if _simulator is None:
+            import qiskit_aer as qe
+            _simulator = qe.Aer.get_backend('qasm_simulator')
+        return _simulator
 
-    # Check if the size of the keys is a multiple of 8
-    if num_bits_per_key % 8 != 0:
-        return Response({"error": "Key size must be a multiple of 8"}, status=status.HTTP_400_BAD_REQUEST)
+
+def get_noise_model():
+    """
+    Retrieve the Aer noise model of the simulated channel (BB84_NOISE_DEPOLARIZING and
+    BB84_NOISE_READOUT), created on first use, or None for a noiseless channel.
+    """
+    depolarizing, readout = settings.BB84_NOISE_DEPOLARIZING, settings.BB84_NOISE_READOUT
+    if not depolarizing and not readout:
+        return None
+
+    with _simulator_lock:
+        if (depolarizing, readout) not in _noise_models:
+            from qiskit_aer.noise import NoiseModel, ReadoutError, depolarizing_error
+
+            noise_model = NoiseModel()
+            if depolarizing:
+                # Channel noise: each qubit may be depolarized before Bob measures it.
+                noise_model.add_all_qubit_quantum_error(depolarizing_error(depolarizing, 1), ['measure'])
+            if readout:
+                noise_model.add_all_qubit_readout_error(
+                    ReadoutError([[1 - readout, readout], [readout, 1 - readout]]))
+            _noise_models[(depolarizing, readout)] = noise_model
+        return _noise_models[(depolarizing, readout)]
+
+
+def run_circuits(circuits):
+    """
+    Transpile circuits for the simulator and run them as a single job of one shot, through
+    the noise model of the channel if one is configured. Returns the result.
+    """
+    from qiskit import transpile
+
+    simulation = get_simulator()
+    job = simulation.run(transpile(circuits, simulation), shots=1, memory=True, noise_model=get_noise_model())
+    return job.result()
+
+
+def random_bb84_inputs(num_keys, num_bits_per_key):
+    """
+    Draw Alice's bits and bases and Bob's bases for a whole batch of keys.
+    Each array has the shape (num_keys, num_bits_per_key).
+    """
+    alice_bits = np.random.randint(2, size=(num_keys, num_bits_per_key), dtype=np.uint8)
+    alice_basis = np.random.randint(2, size=(num_keys, num_bits_per_key), dtype=np.uint8)
+    bob_basis = np.random.randint(2, size=(num_keys, num_bits_per_key), dtype=np.uint8)
+    return alice_bits, alice_basis, bob_basis
+
+
+def pack_sifted_keys(bits, matching):
+    """
+    Keep the bits of each key where Alice's and Bob's bases match and pack them into bytes.
+    The sifted keys are truncated to a whole number of bytes.
+    """
+    keys = []
+    for key_bits, key_matching in zip(bits, matching):
+        sifted = np.asarray(key_bits, dtype=np.uint8)[key_matching]
+        keys.append(np.packbits(sifted[:sifted.size - sifted.size % 8]).tobytes())
+    return keys
+
+
+def build_bb84_circuit(alice_bits, alice_basis, bob_basis):
+    """Build the BB84 circuit preparing Alice's qubits and measuring them in Bob's bases."""
+    from qiskit import QuantumCircuit
+
+    num_bits = len(alice_bits)
+
+    # Preparation of qubits.
+    qc = QuantumCircuit(num_bits, num_bits)
+    for i in range(num_bits):
+        if alice_bits[i] == 1:  # Bit de base
+            qc.x(i)
+        if alice_basis[i] == 1:  # Base diagonale
+            qc.h(i)
+
+    qc.barrier()
+
+    # Measurement by Bob.
+    for i in range(num_bits):
+        if bob_basis[i] == 1:
+            qc.h(i)  # If Bob's basis is diagonal, apply H before measuring.
+
+    qc.barrier()
+
+    # Measurement of Bob's bits
+    for i in range(num_bits):
+        qc.measure(i, i)
+
+    return qc
+
+
+def generate_keys_qiskit(num_keys, num_bits_per_key):
+    """Generate the keys by simulating one BB84 circuit per key on the qasm_simulator."""
+    all_keys = []
 
     for _ in range(num_keys):
         # Random generation of bits and bases for each key.
@@ -21,41 +120,177 @@ def generate_bb84_keys(num_keys, num_bits_per_key):
         alice_basis = np.random.randint(2, size=num_bits_per_key)
         bob_basis = np.random.randint(2, size=num_bits_per_key)
 
-        # Preparation of qubits.
-        qc = QuantumCircuit(num_bits_per_key, num_bits_per_key)
-        for i in range(num_bits_per_key):
-            if alice_bits[i] == 1:  # Bit de base
-                qc.x(i)
-            if alice_basis[i] == 1:  # Base diagonale
-                qc.h(i)
-
-        qc.barrier()
-
-        # Measurement by Bob.
-        for i in range(num_bits_per_key):
-            if bob_basis[i] == 1:
-                qc.h(i)  # If Bob's basis is diagonal, apply H before measuring.
-
-        qc.barrier()
-
-        # Measurement of Bob's bits
-        for i in range(num_bits_per_key):
-            qc.measure(i, i)
+        qc = build_bb84_circuit(alice_bits, alice_basis, bob_basis)
 
         # Execution with simulation (backend qasm_simulator).
-        simulation = qe.Aer.get_backend('qasm_simulator')
-        job = simulation.run(transpile(qc, simulation), shots=1, memory=True)
-        result = job.result()
+        result = run_circuits(qc)
         measurements = result.get_memory()[0]
 
         # Retrieve Bob's bits
         bob_bits = [int(measurement) for measurement in measurements]
         bob_bits.reverse()
 
-        # Generate the key from the matching bases between Alice and Bob.
-        key = [int(alice_bits[i]) for i in range(num_bits_per_key) if alice_basis[i] == bob_basis[i]]
+        # Generate the key from Bob's bits where the bases of Alice and Bob match.
+        key = pack_sifted_keys([np.array(bob_bits)], [alice_basis == bob_basis])[0]
 
         # Add the key to the list of generated keys.
         all_keys.append(key)
 
     return all_keys
+
+
+def simulate_bob_bits(alice_bits, alice_basis, bob_basis, block_size):
+    """
+    Measure Alice's qubits in Bob's bases on the qasm_simulator and return Bob's bits.
+
+    The inputs are flattened and split into independent circuits of at most
+    block_size qubits, which are transpiled together and submitted as a single
+    Aer job. Bob's bits are returned with the shape of the inputs.
+    """
+    alice_bits, alice_basis, bob_basis = (array.ravel() for array in (alice_bits, alice_basis, bob_basis))
+    blocks = range(0, alice_bits.size, block_size)
+    circuits = [
+        build_bb84_circuit(alice_bits[start:start + block_size],
+                           alice_basis[start:start + block_size],
+                           bob_basis[start:start + block_size])
+        for start in blocks
+    ]
+
+    result = run_circuits(circuits)
+
+    # Bob's bits of each experiment, in qubit order.
+    memory = ''.join(result.get_memory(i)[0][::-1] for i in range(len(circuits)))
+    return np.frombuffer(memory.encode(), dtype=np.uint8) - ord('0')
+
+
+def generate_keys_qiskit_batched(num_keys, num_bits_per_key):
+    """
+    Generate the keys by simulating all the circuits of the request in a single Aer job.
+    The circuits are transpiled together and submitted with one backend.run call.
+    """
+    alice_bits, alice_basis, bob_basis = random_bb84_inputs(num_keys, num_bits_per_key)
+    bob_bits = simulate_bob_bits(alice_bits, alice_basis, bob_basis, num_bits_per_key)
+    bob_bits = bob_bits.reshape(num_keys, num_bits_per_key)
+
+    # On the noiseless simulator Bob's sifted bits are Alice's sifted bits.
+    matching = alice_basis == bob_basis
+    return pack_sifted_keys(bob_bits, matching)
+
+
+def generate_keys_qiskit_chunked(num_keys, num_bits_per_key):
+    """
+    Generate the keys like generate_keys_qiskit_batched, but with circuits of at most
+    BB84_CHUNK_QUBITS qubits so the simulator state does not grow with the key size.
+    """
+    alice_bits, alice_basis, bob_basis = random_bb84_inputs(num_keys, num_bits_per_key)
+    bob_bits = simulate_bob_bits(alice_bits, alice_basis, bob_basis, settings.BB84_CHUNK_QUBITS)
+    bob_bits = bob_bits.reshape(num_keys, num_bits_per_key)
+
+    matching = alice_basis == bob_basis
+    return pack_sifted_keys(bob_bits, matching)
+
+
+def generate_keys_analytic(num_keys, num_bits_per_key):
+    """
+    Generate the keys of an ideal, noiseless BB84 channel without a simulator.
+
+    On such a channel Bob reads Alice's bit whenever the bases match, so the
+    sifted key is fully determined by the bit and basis arrays and the whole
+    batch can be sifted at once.
+    """
+    alice_bits, alice_basis, bob_basis = random_bb84_inputs(num_keys, num_bits_per_key)
+    matching = alice_basis == bob_basis
+
+    return pack_sifted_keys(alice_bits, matching)
+
+
+def simulate_raw_qubits(num_qubits, engine):
+    """
+    Send num_qubits raw BB84 qubits, with independent random bases for Alice and Bob.
+    Returns Alice's bits, Bob's bits and the mask of the qubits whose bases match.
+
+    The qiskit engines simulate circuits of at most BB84_CHUNK_QUBITS qubits: 'qiskit' runs
+    one Aer job per circuit, 'qiskit_batched' and 'qiskit_chunked' a single job for all of them.
+    With the analytic engine Bob reads Alice's bit in the matching basis and a random bit otherwise.
+    """
+    alice_bits, alice_basis, bob_basis = (array.ravel() for array in random_bb84_inputs(1, num_qubits))
+    matching = alice_basis == bob_basis
+    block_size = settings.BB84_CHUNK_QUBITS
+
+    if engine == 'analytic':
+        random_bits = np.random.randint(2, size=num_qubits, dtype=np.uint8)
+        bob_bits = np.where(matching, alice_bits, random_bits)
+    elif engine == 'qiskit':
+        bob_bits = np.concatenate([
+            simulate_bob_bits(alice_bits[start:start + block_size], alice_basis[start:start + block_size],
+                              bob_basis[start:start + block_size], block_size)
+            for start in range(0, num_qubits, block_size)
+        ])
+    else:
+        bob_bits = simulate_bob_bits(alice_bits, alice_basis, bob_basis, block_size)
+    return alice_bits, bob_bits, matching
+
+
+def generate_sifted_pairs(num_bits, engine=None):
+    """
+    Generate at least num_bits sifted BB84 bits: Alice's bits and Bob's bits where their bases match.
+
+    Raw qubits are sent in whole circuits of BB84_CHUNK_QUBITS qubits until enough of them
+    are sifted. About half of them are measured in the wrong basis and discarded; every
+    sifted bit is returned, so that the caller can keep the surplus over num_bits.
+    """
+    engine = engine or settings.BB84_ENGINE
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown BB84 engine: {engine}")
+
+    block_size = settings.BB84_CHUNK_QUBITS
+    alice_sifted = [np.empty(0, dtype=np.uint8)]
+    bob_sifted = [np.empty(0, dtype=np.uint8)]
+    sifted = 0
+    while sifted < num_bits:
+        # Twice the missing bits in raw qubits: about half of them survive the sifting.
+        num_qubits = -(-2 * (num_bits - sifted) // block_size) * block_size
+        alice_bits, bob_bits, matching = simulate_raw_qubits(num_qubits, engine)
+        alice_sifted.append(alice_bits[matching])
+        bob_sifted.append(bob_bits[matching])
+        sifted += int(matching.sum())
+    return np.concatenate(alice_sifted), np.concatenate(bob_sifted)
+
+
+def generate_sifted_bits(num_bits, engine=None):
+    """Generate at least num_bits sifted BB84 bits (Bob's bits)."""
+    return generate_sifted_pairs(num_bits, engine)[1]
+
+
+# Available BB84 engines, selected with the BB84_ENGINE setting.
+ENGINES = {
+    'qiskit': generate_keys_qiskit,
+    'qiskit_batched': generate_keys_qiskit_batched,
+    'qiskit_chunked': generate_keys_qiskit_chunked,
+    'analytic': generate_keys_analytic,
+}
+
+
+def generate_bb84_keys(num_keys, num_bits_per_key, engine=None):
+    """
+    Generate multiple keys using the BB84 protocol.
+    Returns the sifted keys packed into bytes (most significant bit first).
+    """
+
+    # Check if the size of the keys is a multiple of 8
+    if num_bits_per_key % 8 != 0:
+        raise ValueError("Key size must be a multiple of 8")
+
+    engine = engine or settings.BB84_ENGINE
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown BB84 engine: {engine}")
+
+    return ENGINES[engine](num_keys, num_bits_per_key)
+
+
+def warm_up(engine=None):
+    """
+    Load an engine ahead of the first request: for the qiskit engines, import Qiskit and Aer,
+    create the simulator of this process and run a small circuit through the transpiler.
+    """
+    generate_bb84_keys(num_keys=1, num_bits_per_key=8, engine=engine)
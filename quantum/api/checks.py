@@ -0,0 +1,22 @@
+import base64
+import binascii
+
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+
+@register(Tags.security)
+def check_kek_master_key(app_configs, **kwargs):
+    """KEK_MASTER_KEY must be set (it is only derived from SECRET_KEY with DEBUG) to a valid AES key."""
+    if not settings.KEK_MASTER_KEY:
+        return [Error("KEK_MASTER_KEY is not set.",
+                      hint="Set the KEK_MASTER_KEY environment variable to a random base64 AES key "
+                           "(16, 24 or 32 bytes), kept outside the repository.",
+                      id='api.E001')]
+    try:
+        master_key = base64.b64decode(settings.KEK_MASTER_KEY, validate=True)
+    except binascii.Error:
+        master_key = b''
+    if len(master_key) not in (16, 24, 32):
+        return [Error("KEK_MASTER_KEY is not a base64 AES key of 16, 24 or 32 bytes.", id='api.E002')]
+    return []
@@ -1,15 +1,18 @@
 import base64
 import hashlib
 
+import numpy as np
+
 from Crypto.Cipher import AES
 from Crypto.Hash import SHA256
+from Crypto.Random import get_random_bytes
 from Crypto.Util.Padding import pad, unpad
 
+GCM_NONCE_SIZE = 12
+GCM_TAG_SIZE = 16
 
-def hash_key(bits):
-    """Convert a list of bits into a key usable for AES encryption."""
-    bit_str = ''.join(str(bit) for bit in bits)
-    key_raw = int(bit_str, 2).to_bytes((len(bit_str) + 7) // 8, 'big')
+def hash_key(key_raw):
+    """Convert a packed key into a key usable for AES encryption."""
     hash_code = SHA256.new(key_raw)
     hash_code.update(key_raw)
     return hash_code.digest()[:16]
@@ -18,14 +21,14 @@ def hash_key(bits):
 def encrypt_key_aes(key, aes_key):
     """
     Encrypt the binary BB84 key with AES.
-    :param key: The key to encrypt (generated by BB84).
+    :param key: The key to encrypt (generated by BB84), as bytes.
     :param aes_key: The AES symmetric key used for encryption.
     :return: The encrypted key in base64.
     """
 
     cipher = AES.new(aes_key, AES.MODE_CBC)  # Using AES in CBC mode.
     iv = cipher.iv
-    ct_bytes = cipher.encrypt(pad(key.encode(), AES.block_size))  # Encryption of the key.
+    ct_bytes = cipher.encrypt(pad(key, AES.block_size))  # Encryption of the key.
 
     ciphertext = base64.b64encode(iv + ct_bytes).decode('utf-8')  # Encrypted key.
     return {"iv": iv, "ciphertext": ciphertext}
@@ -36,7 +39,7 @@ def decrypt_key_aes(encrypted_key, aes_key):
     Decrypts an AES key in CBC mode.
     :param encrypted_key: The key encrypted in base64.
     :param aes_key: The symmetric AES key used for decryption.
-    :return: The decrypted key as text.
+    :return: The decrypted key as bytes.
     """
 
     # Decode the IV and the encrypted text from base64 format.
@@ -49,6 +52,86 @@ def decrypt_key_aes(encrypted_key, aes_key):
     # Decrypt and unpad the data.
     decrypted_key_block = cipher.decrypt(encrypted_key_decode[AES.block_size:])
     decrypted_key = unpad(decrypted_key_block, AES.block_size)
-    decrypted_key_list = [int(char) for char in decrypted_key.decode()]
 
-    return decrypted_key_list
+    return decrypted_key
+
+
+def encrypt_keys_aes(keys, aes_key, mode='CBC'):
+    """
+    Encrypt a batch of binary BB84 keys with the same AES key.
+    :param keys: The keys to encrypt, as bytes.
+    :param aes_key: The AES symmetric key used for encryption.
+    :param mode: 'CBC' (IV + ciphertext, compatible with encrypt_key_aes)
+                 or 'GCM' (nonce + ciphertext + tag).
+    :return: The encrypted keys as bytes.
+    """
+    if mode == 'GCM':
+        encrypted_keys = []
+        for key in keys:
+            cipher = AES.new(aes_key, AES.MODE_GCM, nonce=get_random_bytes(GCM_NONCE_SIZE))
+            ct_bytes, tag = cipher.encrypt_and_digest(key)
+            encrypted_keys.append(cipher.nonce + ct_bytes + tag)
+        return encrypted_keys
+
+    if not keys:
+        return []
+
+    # CBC chains the blocks of a key, but the keys are independent: the j-th block of every
+    # key is encrypted in a single call with one key schedule, on a preallocated buffer.
+    cipher = AES.new(aes_key, AES.MODE_ECB)
+    padded_keys = [pad(key, AES.block_size) for key in keys]
+    block_counts = np.array([len(key) // AES.block_size for key in padded_keys])
+    blocks = np.zeros((len(keys), block_counts.max() + 1, AES.block_size), dtype=np.uint8)
+    for i, key in enumerate(padded_keys):
+        blocks[i, 1:block_counts[i] + 1] = np.frombuffer(key, dtype=np.uint8).reshape(-1, AES.block_size)
+
+    # The IV is the block 0 of each encrypted key.
+    blocks[:, 0] = np.frombuffer(get_random_bytes(len(keys) * AES.block_size), dtype=np.uint8).reshape(-1, AES.block_size)
+    for j in range(1, blocks.shape[1]):
+        active = block_counts >= j
+        chained = blocks[active, j] ^ blocks[active, j - 1]
+        blocks[active, j] = np.frombuffer(cipher.encrypt(chained.tobytes()), dtype=np.uint8).reshape(-1, AES.block_size)
+
+    return [blocks[i, :block_counts[i] + 1].tobytes() for i in range(len(keys))]
+
+
+def decrypt_keys_aes(encrypted_keys, aes_key, mode='CBC'):
+    """
+    Decrypt a batch of keys encrypted with encrypt_keys_aes under the same AES key.
+    :param encrypted_keys: The encrypted keys, as bytes.
+    :param aes_key: The symmetric AES key used for decryption.
+    :param mode: 'CBC' or 'GCM', the mode used for encryption.
+    :return: The decrypted keys as bytes.
+    """
+    if mode == 'GCM':
+        decrypted_keys = []
+        for encrypted_key in encrypted_keys:
+            nonce = encrypted_key[:GCM_NONCE_SIZE]
+            cipher = AES.new(aes_key, AES.MODE_GCM, nonce=nonce)
+            decrypted_keys.append(cipher.decrypt_and_verify(encrypted_key[GCM_NONCE_SIZE:-GCM_TAG_SIZE],
+                                                            encrypted_key[-GCM_TAG_SIZE:]))
+        return decrypted_keys
+
+    if not encrypted_keys:
+        return []
+
+    # CBC decryption is not chained: all the blocks of the batch are decrypted in one call
+    # and XORed with the preceding ciphertext block.
+    cipher = AES.new(aes_key, AES.MODE_ECB)
+    ciphertext = np.frombuffer(b''.join(encrypted_keys), dtype=np.uint8).reshape(-1, AES.block_size)
+    plaintext = np.frombuffer(cipher.decrypt(ciphertext.tobytes()), dtype=np.uint8).reshape(-1, AES.block_size)
+
+    decrypted_keys = []
+    offset = 0
+    for encrypted_key in encrypted_keys:
+        block_count = len(encrypted_key) // AES.block_size
+        # Block 0 is the IV: block j is decrypted with the ciphertext block j - 1.
+        blocks = plaintext[offset + 1:offset + block_count] ^ ciphertext[offset:offset + block_count - 1]
+        decrypted_keys.append(unpad(blocks.tobytes(), AES.block_size))
+        offset += block_count
+    return decrypted_keys
+
+
+def key_to_bits(key, num_bits=None):
+    """Convert a packed key into the legacy list of bits, without the padding bits beyond num_bits."""
+    return np.unpackbits(np.frombuffer(key, dtype=np.uint8), count=num_bits).tolist()
@@ -0,0 +1,140 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from Crypto.Random import get_random_bytes
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .keygen import get_executor, generate_encrypted_keys
+from .reservoir import link_id
+from .models import KeyGenerationJob
+from .service import store_generated_keys, release_key_capacity
+
+_job_threads = None
+_job_threads_lock = threading.Lock()
+
+
+def create_key_job(key_request):
+    """
+    Records a validated key generation request as a pending job and schedules it.
+    The storage of the keys must already be reserved in the KME.
+    """
+    job = KeyGenerationJob.objects.create(
+        kme=key_request['kme'],
+        master_sae=key_request['master_sae'],
+        number=key_request['number'],
+        size=key_request['size'],
+    )
+    job.target_saes.set(key_request['target_saes'])
+
+    if settings.KEY_JOBS_IN_PROCESS:
+        submit_key_job(job.job_id)
+    return job
+
+
+def get_job_threads():
+    """Retrieve the background threads running the jobs of this process, creating them on first use."""
+    global _job_threads
+    with _job_threads_lock:
+        if _job_threads is None:
+            _job_threads = ThreadPoolExecutor(max_workers=settings.KEY_JOB_THREADS, thread_name_prefix='key-job')
+        return _job_threads
+
+
+def submit_key_job(job_id):
+    """Runs a job in the background threads of this process."""
+    get_job_threads().submit(_run_key_job_in_thread, job_id)
+
+
+def resume_key_jobs():
+    """
+    Takes over the jobs left by stopped processes in the background threads of this process,
+    when a web process starts (KEY_JOBS_IN_PROCESS): the stale running jobs are re-queued
+    and every pending job is scheduled (a job taken by another process is skipped).
+    """
+    get_job_threads().submit(_resume_key_jobs_in_thread)
+
+
+def requeue_stale_key_jobs():
+    """
+    Re-queues the running jobs whose process stopped: those not updated for KEY_JOB_STALE_AFTER
+    seconds (a running job is updated after each chunk). They resume from the keys already stored.
+    Returns the number of re-queued jobs.
+    """
+    stale = timezone.now() - timedelta(seconds=settings.KEY_JOB_STALE_AFTER)
+    return KeyGenerationJob.objects.filter(status=KeyGenerationJob.RUNNING, updated_at__lt=stale).update(
+        status=KeyGenerationJob.PENDING, updated_at=timezone.now())
+
+
+def run_key_job(job_id):
+    """
+    Generates and stores the keys of a pending job, chunk by chunk so that its progress can be followed.
+    The simulation and the encryption run in the key generation process pool.
+    Returns False if the job was not pending (e.g. already taken by another worker).
+    """
+    # Take the job, unless another worker already did.
+    if not KeyGenerationJob.objects.filter(job_id=job_id, status=KeyGenerationJob.PENDING).update(
+            status=KeyGenerationJob.RUNNING, updated_at=timezone.now()):
+        return False
+
+    job = KeyGenerationJob.objects.select_related('kme', 'master_sae').get(job_id=job_id)
+    target_saes = list(job.target_saes.all())
+    aes_key = get_random_bytes(16)
+    stored = len(job.key_ids)  # A re-queued job resumes after the keys already stored.
+    try:
+        while stored < job.number:
+            number = min(job.number - stored, settings.KEY_JOB_CHUNK_SIZE)
+            future = get_executor().submit(generate_encrypted_keys, number, job.size, aes_key,
+                                           settings.BB84_ENGINE, settings.KEY_ENCRYPTION_MODE,
+                                           link_id(job.kme, job.kme))
+            keys, encrypted_keys = future.result(timeout=settings.KEYGEN_TIMEOUT)
+            stored_keys = store_generated_keys(keys, aes_key, job.master_sae, target_saes, encrypted_keys)
+
+            job.key_ids += [stored_key['key_ID'] for stored_key in stored_keys]
+            job.save(update_fields=['key_ids', 'updated_at'])
+            stored += number
+    except Exception as error:
+        # Give back the storage reserved for the keys that were not stored.
+        release_key_capacity(job.kme, job.number - stored)
+        job.status = KeyGenerationJob.FAILED
+        job.error = str(error) or error.__class__.__name__
+        job.save(update_fields=['status', 'error', 'updated_at'])
+        return True
+
+    job.status = KeyGenerationJob.DONE
+    job.save(update_fields=['status', 'updated_at'])
+    return True
+
+
+def _run_key_job_in_thread(job_id):
+    try:
+        run_key_job(job_id)
+    finally:
+        # The background threads do not go through the request cycle that recycles connections.
+        close_old_connections()
+
+
+def _resume_key_jobs_in_thread():
+    try:
+        requeue_stale_key_jobs()
+        for job_id in get_pending_key_jobs():
+            submit_key_job(job_id)
+    finally:
+        close_old_connections()
+
+
+def get_pending_key_jobs():
+    """IDs of the pending jobs, in creation order."""
+    return list(KeyGenerationJob.objects.filter(status=KeyGenerationJob.PENDING).order_by('created_at')
+                .values_list('job_id', flat=True))
+
+
+def run_pending_key_jobs():
+    """
+    Runs the pending jobs in creation order, after re-queuing the stale running ones.
+    Returns the number of jobs run.
+    """
+    requeue_stale_key_jobs()
+    return sum(run_key_job(job_id) for job_id in get_pending_key_jobs())
@@ -0,0 +1,99 @@
+import base64
+import threading
+import time
+from collections import OrderedDict
+
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .encryptor import GCM_NONCE_SIZE, GCM_TAG_SIZE
+from .models import KeyEncryptionKey
+
+# In-process LRU cache of the unwrapped KEKs: kek_id -> (expiry time, AES key, mode).
+_kek_cache = OrderedDict()
+_kek_lock = threading.Lock()
+
+
+class KEKUnwrapError(Exception):
+    """Raised when a stored KEK cannot be unwrapped with the configured master key."""
+
+
+def get_master_key():
+    """Master key wrapping the KEKs (KEK_MASTER_KEY). Raises ImproperlyConfigured if it is not set."""
+    if not settings.KEK_MASTER_KEY:
+        raise ImproperlyConfigured("KEK_MASTER_KEY must be set when DEBUG is off.")
+    return base64.b64decode(settings.KEK_MASTER_KEY)
+
+
+def wrap_key(kek_id, aes_key):
+    """Encrypt a KEK under the master key (AES-GCM, bound to the KEK ID). Returns nonce + ciphertext + tag."""
+    cipher = AES.new(get_master_key(), AES.MODE_GCM, nonce=get_random_bytes(GCM_NONCE_SIZE))
+    cipher.update(kek_id.bytes)
+    ct_bytes, tag = cipher.encrypt_and_digest(aes_key)
+    return cipher.nonce + ct_bytes + tag
+
+
+def unwrap_key(kek_id, wrapped_key):
+    """
+    Decrypt a KEK wrapped with wrap_key.
+    Raises ValueError if it was not wrapped for this KEK ID with the master key.
+    """
+    wrapped_key = bytes(wrapped_key)
+    cipher = AES.new(get_master_key(), AES.MODE_GCM, nonce=wrapped_key[:GCM_NONCE_SIZE])
+    cipher.update(kek_id.bytes)
+    return cipher.decrypt_and_verify(wrapped_key[GCM_NONCE_SIZE:-GCM_TAG_SIZE], wrapped_key[-GCM_TAG_SIZE:])
+
+
+def _cache_kek(kek_id, aes_key, mode, now):
+    with _kek_lock:
+        _kek_cache[kek_id] = (now + settings.KEK_CACHE_TTL, aes_key, mode)
+        _kek_cache.move_to_end(kek_id)
+        while len(_kek_cache) > settings.KEK_CACHE_SIZE:
+            _kek_cache.popitem(last=False)
+
+
+def create_kek(aes_key, mode):
+    """
+    Create the (unsaved) KEK of a batch of keys encrypted with aes_key, wrapped under the master key.
+    The unwrapped key is cached right away, so the batch can be decrypted without a lookup.
+    """
+    kek = KeyEncryptionKey(mode=mode)
+    kek.wrapped_key = wrap_key(kek.kek_id, aes_key)
+    _cache_kek(kek.kek_id, aes_key, mode, time.monotonic())
+    return kek
+
+
+def get_keks(kek_ids):
+    """
+    Retrieve unwrapped KEKs by ID, from the cache or in a single query for the missing ones.
+    Returns a dict kek_id -> (AES key, mode).
+    Raises KEKUnwrapError if a KEK was wrapped with another master key.
+    """
+    now = time.monotonic()
+    keks = {}
+    with _kek_lock:
+        for kek_id in kek_ids:
+            entry = _kek_cache.get(kek_id)
+            if entry and entry[0] > now:
+                _kek_cache.move_to_end(kek_id)
+                keks[kek_id] = entry[1:]
+
+    missing = [kek_id for kek_id in kek_ids if kek_id not in keks]
+    if missing:
+        for kek in KeyEncryptionKey.objects.filter(kek_id__in=missing):
+            try:
+                aes_key = unwrap_key(kek.kek_id, kek.wrapped_key)
+            except ValueError:
+                raise KEKUnwrapError(f"The key-encryption key {kek.kek_id} cannot be unwrapped with the "
+                                     f"configured master key (KEK_MASTER_KEY)")
+            _cache_kek(kek.kek_id, aes_key, kek.mode, now)
+            keks[kek.kek_id] = (aes_key, kek.mode)
+    return keks
+
+
+def clear_kek_cache():
+    """Drop every cached KEK of this process."""
+    with _kek_lock:
+        _kek_cache.clear()
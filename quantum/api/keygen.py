@@ -0,0 +1,97 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+
+from .bb84 import warm_up
+from .reservoir import generate_keys
+from .encryptor import encrypt_keys_aes
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending_jobs = 0
+
+
+class KeyGenerationBusy(Exception):
+    """Raised when the key generation queue is full."""
+
+
+def generate_encrypted_keys(number_of_keys, num_bits_per_key, aes_key, engine, mode, link):
+    """
+    Generate BB84 keys on a KME link and encrypt them with the AES key, in a worker process of the
+    key generation pool (each worker has its own link reservoirs).
+    Returns the keys and their encrypted form, as bytes.
+    """
+    keys = generate_keys(link, number_of_keys, num_bits_per_key, engine)
+    return keys, encrypt_keys_aes(keys, aes_key, mode)
+
+
+def init_worker():
+    """Set up Django in a key generation worker and, with BB84_PRELOAD, load the BB84 engine before its first job."""
+    django.setup()
+    if settings.BB84_PRELOAD:
+        warm_up()
+
+
+def get_executor():
+    """
+    Retrieve the process pool of this process running the key generations, creating it on first use.
+    The workers are spawned (not forked from a multi-threaded server) and set up Django on start.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.KEYGEN_POOL_SIZE,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_worker,
+            )
+        return _executor
+
+
+def preload_workers():
+    """
+    Start the key generation workers ahead of the first request, so that they import and warm up
+    the BB84 engine (BB84_PRELOAD) while the server starts. Does not wait for them.
+    """
+    executor = get_executor()
+    for _ in range(settings.KEYGEN_POOL_SIZE):
+        executor.submit(os.getpid)
+
+
+async def run_key_generation(number_of_keys, num_bits_per_key, aes_key, link):
+    """
+    Run generate_encrypted_keys in the process pool without blocking the event loop.
+    Raises KeyGenerationBusy if KEYGEN_QUEUE_DEPTH generations are already queued or running,
+    and asyncio.TimeoutError if the generation takes more than KEYGEN_TIMEOUT seconds.
+    """
+    global _pending_jobs
+    with _executor_lock:
+        if _pending_jobs >= settings.KEYGEN_QUEUE_DEPTH:
+            raise KeyGenerationBusy("Too many key generation requests, try again later.")
+        _pending_jobs += 1
+
+    try:
+        future = get_executor().submit(generate_encrypted_keys, number_of_keys, num_bits_per_key, aes_key,
+                                       settings.BB84_ENGINE, settings.KEY_ENCRYPTION_MODE, link)
+    except BaseException:
+        _release_job_slot()
+        raise
+    # The slot is held until the generation is over: a timed out generation keeps its worker.
+    future.add_done_callback(_release_job_slot)
+
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), settings.KEYGEN_TIMEOUT)
+    except asyncio.TimeoutError:
+        future.cancel()  # Only effective if the generation has not started yet.
+        raise
+
+
+def _release_job_slot(future=None):
+    global _pending_jobs
+    with _executor_lock:
+        _pending_jobs -= 1
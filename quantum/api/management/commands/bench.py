@@ -0,0 +1,278 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+from Crypto.Random import get_random_bytes
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (CaptureQueriesContext, override_settings, setup_test_environment,
+                               teardown_test_environment)
+from rest_framework.test import APIClient
+
+from api.bb84 import ENGINES, generate_bb84_keys
+from api.encryptor import encrypt_key_aes, decrypt_key_aes, encrypt_keys_aes, decrypt_keys_aes
+from api.models import KME, SAE
+from api.postprocessing import amplify_privacy, estimate_qber, toeplitz_hash
+from api.reservoir import clear_reservoirs, take_exact_keys
+from api.service import store_generated_keys
+from api.topology import clear_topology_cache
+
+
+# Run in a fresh interpreter: time the start of the application, then the first (cold)
+# and the second (warm) generation with an engine.
+STARTUP_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import django
+django.setup()
+import quantum.urls
+loaded = time.perf_counter()
+qiskit_loaded = 'qiskit' in sys.modules
+from api.bb84 import generate_bb84_keys
+generate_bb84_keys(1, 16, engine=sys.argv[1])
+first = time.perf_counter()
+generate_bb84_keys(1, 16, engine=sys.argv[1])
+second = time.perf_counter()
+print(json.dumps({
+    "startup_seconds": loaded - start,
+    "qiskit_loaded_at_startup": qiskit_loaded,
+    "first_generation_seconds": first - loaded,
+    "warm_generation_seconds": second - first,
+}))
+'''
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+def timed(function, repeat):
+    """Run a function `repeat` times. Returns its timings in seconds (min, median, mean) and its last result."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return {
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "mean": statistics.fmean(timings),
+    }, result
+
+
+def counted(function):
+    """Run a function once. Returns the number of SQL queries it executed and its result."""
+    with CaptureQueriesContext(connection) as queries:
+        result = function()
+    return len(queries), result
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the application startup, the BB84 engines and post-processing, the AES encryption, "
+            "the key storage and the KME endpoints on a throwaway test database, and print the results as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--engine', dest='engines', action='append', choices=sorted(ENGINES), default=[],
+                            help="BB84 engine to benchmark (default: all engines). May be repeated.")
+        parser.add_argument('--num-keys', type=int_list, default=[1, 16, 64],
+                            help="Comma-separated numbers of keys of the generation grid.")
+        parser.add_argument('--sizes', type=int_list, default=[64, 256],
+                            help="Comma-separated key sizes (bits) of the generation grid.")
+        parser.add_argument('--pa-block-sizes', type=int_list, default=[1024, 4096, 10240, 16384],
+                            help="Comma-separated block sizes (bits) of the post-processing benchmark.")
+        parser.add_argument('--pa-blocks', type=int, default=16,
+                            help="Number of blocks post-processed together.")
+        parser.add_argument('--batch', type=int, default=256,
+                            help="Number of keys of the encryption, storage and endpoint benchmarks.")
+        parser.add_argument('--repeat', type=int, default=5, help="Number of runs of each benchmark.")
+        parser.add_argument('--output', help="Write the results to this file instead of the standard output.")
+
+    def handle(self, *args, **options):
+        results = {
+            "commit": self.get_commit(),
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            "options": {name: options[name] for name in ('num_keys', 'sizes', 'pa_block_sizes', 'pa_blocks', 'batch',
+                                                         'repeat')},
+            "startup": self.bench_startup(options['engines'] or sorted(ENGINES)),
+            "bb84": self.bench_bb84(options['engines'] or sorted(ENGINES), options['num_keys'], options['sizes'],
+                                    options['repeat']),
+            "postprocessing": self.bench_postprocessing(options['pa_block_sizes'], options['pa_blocks'],
+                                                        options['repeat']),
+            "encryptor": self.bench_encryptor(options['batch'], options['repeat']),
+        }
+
+        # The storage and the endpoints run on a test database, destroyed afterwards.
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(BB84_ENGINE='analytic', KEY_POOL_ENABLED=False):
+                results["store"] = self.bench_store(options['batch'], options['repeat'])
+                results["endpoints"] = self.bench_endpoints(options['batch'], options['repeat'])
+        finally:
+            clear_topology_cache()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def get_commit(self):
+        """Git commit of the benchmarked code, if available."""
+        try:
+            return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                  check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def bench_startup(self, engines):
+        """Application start time and first-request generation latency of each engine, in fresh processes."""
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'quantum.settings'))
+        results = []
+        for engine in engines:
+            process = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, engine], cwd=settings.BASE_DIR, env=env,
+                                     capture_output=True, text=True)
+            if process.returncode:
+                results.append({"engine": engine, "error": process.stderr.strip().splitlines()[-1]})
+            else:
+                results.append({"engine": engine, **json.loads(process.stdout.splitlines()[-1])})
+        return results
+
+    def bench_bb84(self, engines, num_keys_grid, sizes, repeat):
+        """
+        The two key generation paths over the (engine, number of keys, key size) grid: the sifted
+        keys of generate_bb84_keys, and the exact keys of the link reservoirs (BB84_EXACT_KEYS),
+        starting from an empty reservoir in each cell.
+        """
+        paths = {
+            'sifted': lambda engine, num_keys, size: generate_bb84_keys(num_keys, size, engine=engine),
+            'exact': lambda engine, num_keys, size: take_exact_keys('bench', num_keys, size, engine),
+        }
+        results = []
+        for path, generate in paths.items():
+            for engine in engines:
+                for num_keys in num_keys_grid:
+                    for size in sizes:
+                        result = {"path": path, "engine": engine, "num_keys": num_keys, "size": size}
+                        clear_reservoirs()
+                        try:
+                            timings, _ = timed(lambda: generate(engine, num_keys, size), repeat)
+                            result.update(timings, keys_per_second=num_keys / timings["median"])
+                        except Exception as error:  # E.g. circuits too wide for the simulator.
+                            result["error"] = f"{type(error).__name__}: {error}"
+                        results.append(result)
+        clear_reservoirs()
+        return results
+
+    def bench_postprocessing(self, block_sizes, num_blocks, repeat):
+        """QBER estimation, Toeplitz hashing and the whole privacy amplification of `num_blocks` blocks per size."""
+        rng = np.random.default_rng()
+        results = []
+        for block_bits in block_sizes:
+            bits = rng.integers(0, 2, size=(num_blocks, block_bits), dtype=np.uint8)
+            sample_size = block_bits // 10
+            output_bits = block_bits // 2
+            seeds = rng.integers(0, 2, size=(num_blocks, block_bits + output_bits - 1), dtype=np.uint8)
+
+            result = {"block_bits": block_bits, "blocks": num_blocks}
+            result["estimate_qber"], _ = timed(lambda: estimate_qber(bits, bits, sample_size, rng), repeat)
+            result["toeplitz_hash"], _ = timed(lambda: toeplitz_hash(bits, output_bits, seeds), repeat)
+            result["amplify_privacy"], (amplified, _) = timed(
+                lambda: amplify_privacy(bits, bits, sample_size, 0.11, 64, rng), repeat)
+            result["output_bits_per_second"] = amplified.size / result["amplify_privacy"]["median"]
+            results.append(result)
+        return results
+
+    def bench_encryptor(self, batch, repeat):
+        """Per-key and batch AES encryption and decryption of `batch` keys."""
+        aes_key = get_random_bytes(16)
+        keys = generate_bb84_keys(batch, 256, engine='analytic')
+        results = {}
+
+        timings, encrypted = timed(lambda: [encrypt_key_aes(key, aes_key)['ciphertext'] for key in keys], repeat)
+        results["encrypt_key_aes"] = timings
+        timings, _ = timed(lambda: [decrypt_key_aes(ciphertext, aes_key) for ciphertext in encrypted], repeat)
+        results["decrypt_key_aes"] = timings
+
+        for mode in ('CBC', 'GCM'):
+            timings, encrypted = timed(lambda: encrypt_keys_aes(keys, aes_key, mode), repeat)
+            results[f"encrypt_keys_aes_{mode.lower()}"] = timings
+            timings, decrypted = timed(lambda: decrypt_keys_aes(encrypted, aes_key, mode), repeat)
+            results[f"decrypt_keys_aes_{mode.lower()}"] = timings
+            if decrypted != keys:
+                raise CommandError(f"{mode} batch decryption does not return the encrypted keys")
+        return {"batch": batch, **results}
+
+    def create_topology(self, batch):
+        kme = KME.objects.create(name='bench', hostname='localhost', max_key_count=10 ** 9,
+                                 max_key_per_request=batch)
+        master = SAE.objects.create(name='bench-master', kme=kme, is_master=True)
+        slave = SAE.objects.create(name='bench-slave', kme=kme)
+        return kme, master, slave
+
+    def bench_store(self, batch, repeat):
+        """
+        store_generated_keys, timed for `batch` keys. Its number of queries must not depend
+        on the number of keys (no query per key).
+        """
+        _, master, slave = self.create_topology(batch)
+        aes_key = get_random_bytes(16)
+        keys = generate_bb84_keys(batch, 256, engine='analytic')
+
+        queries = {}
+        for number in (1, batch):
+            queries[number], _ = counted(lambda: store_generated_keys(keys[:number], aes_key, master, [slave]))
+        if queries[1] != queries[batch]:
+            raise CommandError(f"store_generated_keys runs {queries[1]} queries for 1 key "
+                               f"but {queries[batch]} for {batch} keys")
+
+        timings, _ = timed(lambda: store_generated_keys(keys, aes_key, master, [slave]), repeat)
+        return {"batch": batch, "queries": queries[batch], **timings}
+
+    def bench_endpoints(self, batch, repeat):
+        """The status, enc_keys and dec_keys endpoints, through the DRF test client."""
+        _, master, slave = self.create_topology(batch)
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('bench', password=get_random_bytes(16).hex()))
+
+        def check(response):
+            if response.status_code != 200:
+                raise CommandError(f"{response.request['PATH_INFO']} returned {response.status_code}: "
+                                   f"{response.content[:200]}")
+            return response.json()
+
+        def enc_keys():
+            return check(client.post(f'/api/v1/keys/{slave.sae_id}/enc_keys/',
+                                     {'master_sae_id': str(master.sae_id), 'number': batch, 'size': 256},
+                                     format='json'))
+
+        results = {}
+        queries, stored = counted(enc_keys)
+        timings, _ = timed(enc_keys, repeat)
+        results["enc_keys_post"] = {"batch": batch, "queries": queries, **timings}
+
+        key_ids = [key['key_ID'] for key in stored['keys']]
+        dec_keys = lambda: check(client.get(f'/api/v1/keys/{master.sae_id}/dec_keys/', {'key_ID': key_ids}))
+        queries, _ = counted(dec_keys)
+        timings, _ = timed(dec_keys, repeat)
+        results["dec_keys_get"] = {"batch": batch, "queries": queries, **timings}
+
+        enc_keys_page = lambda: check(client.get(f'/api/v1/keys/{slave.sae_id}/enc_keys/'))
+        queries, _ = counted(enc_keys_page)
+        timings, _ = timed(enc_keys_page, repeat)
+        results["enc_keys_get"] = {"queries": queries, **timings}
+
+        status = lambda: check(client.get(f'/api/v1/keys/{slave.sae_id}/status/'))
+        queries, _ = counted(status)
+        timings, _ = timed(status, repeat)
+        results["status"] = {"queries": queries, **timings}
+        return results
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.service import purge_consumed_keys
+
+
+class Command(BaseCommand):
+    help = ("Delete the keys that have been retrieved with dec_keys and consumed by every SAE "
+            "they were shared with.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help="Keep running and purge every INTERVAL seconds.")
+
+    def handle(self, *args, **options):
+        while True:
+            purged = purge_consumed_keys()
+            self.stdout.write(f"{purged} consumed keys purged")
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
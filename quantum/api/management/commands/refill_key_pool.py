@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.models import KME
+from api.pool import refill_key_pool, key_pool_status
+from api.postprocessing import QBERTooHigh
+
+
+class Command(BaseCommand):
+    help = "Top up the pre-generated BB84 key pools of the KMEs between their watermarks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kme', dest='kme_ids', action='append', default=[],
+                            help="ID of a KME to refill (default: all KMEs). May be repeated.")
+        parser.add_argument('--interval', type=float, default=0,
+                            help="Keep running and refill every INTERVAL seconds.")
+
+    def handle(self, *args, **options):
+        while True:
+            kmes = KME.objects.all()
+            if options['kme_ids']:
+                kmes = kmes.filter(kme_id__in=options['kme_ids'])
+
+            for kme in kmes:
+                try:
+                    added = refill_key_pool(kme)
+                except QBERTooHigh as error:
+                    # A noisy or eavesdropped channel: try again at the next interval.
+                    self.stderr.write(f"{kme}: refill aborted: {error}")
+                    continue
+                pool = key_pool_status(kme)
+                self.stdout.write(
+                    f"{kme}: +{added} keys, {pool['available_key_count']}/{pool['capacity']} available, "
+                    f"{pool['refill_rate']:.1f} keys/s, {pool['hits']} hits, {pool['misses']} misses"
+                )
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
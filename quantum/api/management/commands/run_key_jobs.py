@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.jobs import run_pending_key_jobs
+
+
+class Command(BaseCommand):
+    help = "Run the pending asynchronous key generation jobs, after re-queuing the stale running ones."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help="Keep running and poll for pending jobs every INTERVAL seconds.")
+
+    def handle(self, *args, **options):
+        while True:
+            count = run_pending_key_jobs()
+            if count:
+                self.stdout.write(f"{count} key generation jobs run")
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
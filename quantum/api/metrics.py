@@ -0,0 +1,178 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets.
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUERIES_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histogram:
+    """
+    Cumulative histogram of observations, per set of label values, in the Prometheus model.
+    The metrics are kept in memory and are specific to each process.
+    """
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.setdefault(label_values, [0] * (len(self.buckets) + 1) + [0])
+            series[bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self):
+        """The histogram in the Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {label_values: list(values) for label_values, values in self._series.items()}
+
+        for label_values, values in sorted(series.items()):
+            labels = ','.join(f'{name}="{value}"' for name, value in zip(self.label_names, label_values))
+            prefix = labels + ',' if labels else ''
+            count = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), values):
+                count += bucket_count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_sum{{{labels}}} {values[-1]}')
+            lines.append(f'{self.name}_count{{{labels}}} {count}')
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+STAGE_SECONDS = Histogram('kme_stage_seconds', "Duration of the key generation stages.",
+                          ('stage',), SECONDS_BUCKETS)
+REQUEST_SECONDS = Histogram('kme_request_seconds', "Duration of the requests.",
+                            ('view', 'method', 'status'), SECONDS_BUCKETS)
+REQUEST_QUERIES = Histogram('kme_request_queries', "Number of database queries per request.",
+                            ('view', 'method'), QUERIES_BUCKETS)
+REQUEST_DB_SECONDS = Histogram('kme_request_db_seconds', "Time spent in database queries per request.",
+                               ('view', 'method'), SECONDS_BUCKETS)
+HISTOGRAMS = (STAGE_SECONDS, REQUEST_SECONDS, REQUEST_QUERIES, REQUEST_DB_SECONDS)
+
+# Stage durations of the request being processed: stage -> seconds.
+_request_stages = ContextVar('request_stages', default=None)
+
+
+@contextmanager
+def stage(name):
+    """Time a stage of the key generation, in the stage histogram and in the breakdown of the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if settings.METRICS_ENABLED:
+            STAGE_SECONDS.observe(elapsed, name)
+        stages = _request_stages.get()
+        if stages is not None:
+            stages[name] = stages.get(name, 0) + elapsed
+
+
+class QueryRecorder:
+    """Database execute wrapper counting the queries of a request and their duration."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+
+
+def render_metrics():
+    """All the metrics of this process in the Prometheus text format."""
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines += histogram.render()
+    return '\n'.join(lines) + '\n'
+
+
+def clear_metrics():
+    for histogram in HISTOGRAMS:
+        histogram.clear()
+
+
+class MetricsMiddleware:
+    """
+    Records the duration, the database queries and the stage breakdown of each request (METRICS_ENABLED),
+    and logs the requests slower than SLOW_REQUEST_THRESHOLD seconds. Not used if both are disabled.
+    Queries are only counted for synchronous views: asynchronous views run their queries in other threads.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED and not settings.SLOW_REQUEST_THRESHOLD:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+
+        stages = {}
+        token = _request_stages.set(stages)
+        queries = QueryRecorder()
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(queries):
+                response = self.get_response(request)
+        finally:
+            _request_stages.reset(token)
+        self.record(request, response, time.perf_counter() - start, stages, queries)
+        return response
+
+    async def __acall__(self, request):
+        stages = {}
+        token = _request_stages.set(stages)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_stages.reset(token)
+        self.record(request, response, time.perf_counter() - start, stages)
+        return response
+
+    def record(self, request, response, elapsed, stages, queries=None):
+        match = request.resolver_match
+        view = match.view_name if match else 'unmatched'
+        if settings.METRICS_ENABLED:
+            REQUEST_SECONDS.observe(elapsed, view, request.method, str(response.status_code))
+            if queries is not None:
+                REQUEST_QUERIES.observe(queries.count, view, request.method)
+                REQUEST_DB_SECONDS.observe(queries.duration, view, request.method)
+
+        if settings.SLOW_REQUEST_THRESHOLD and elapsed >= settings.SLOW_REQUEST_THRESHOLD:
+            breakdown = ' '.join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in stages.items())
+            if queries is not None:
+                breakdown += f" queries={queries.count} db={queries.duration * 1000:.1f}ms"
+            logger.warning("Slow request %s %s (%s): %.1fms %s", request.method, request.path, view,
+                           elapsed * 1000, breakdown)
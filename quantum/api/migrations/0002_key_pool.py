@@ -0,0 +1,35 @@
+# Generated by Django 5.1.1 on 2026-10-18 19:18
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KeyPool',
+            fields=[
+                ('kme', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='key_pool', serialize=False, to='api.kme')),
+                ('hits', models.IntegerField(default=0)),
+                ('misses', models.IntegerField(default=0)),
+                ('refilled_key_count', models.IntegerField(default=0)),
+                ('refill_rate', models.FloatField(default=0)),
+                ('last_refill_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PooledKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bits', models.TextField()),
+                ('size', models.IntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('pool', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='keys', to='api.keypool')),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.1 on 2026-10-18 19:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_key_pool'),
+    ]
+
+    operations = [
+        # Pooled keys are disposable: the old '0'/'1' strings are dropped and the pool is refilled.
+        migrations.RemoveField(
+            model_name='pooledkey',
+            name='bits',
+        ),
+        migrations.AddField(
+            model_name='pooledkey',
+            name='key',
+            field=models.BinaryField(default=b''),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.1.1 on 2026-10-18 19:52
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_pooled_key_binary'),
+    ]
+
+    operations = [
+        # KeyMaterial.consult_by keeps its table, which becomes the KeyDelivery model.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='KeyDelivery',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('keymaterial', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='api.keymaterial')),
+                        ('sae', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='key_deliveries', to='api.sae')),
+                    ],
+                    options={
+                        'db_table': 'api_keymaterial_consult_by',
+                        'unique_together': {('keymaterial', 'sae')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='keymaterial',
+                    name='consult_by',
+                    field=models.ManyToManyField(related_name='consulted_keys', through='api.KeyDelivery', to='api.sae'),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='keydelivery',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='keydelivery',
+            name='consumed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='keydelivery',
+            index=models.Index(condition=models.Q(('consumed_at__isnull', True)), fields=['sae', 'created_at', 'id'], name='api_keydelivery_queue_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.1 on 2026-10-18 19:28
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_key_delivery_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KeyGenerationJob',
+            fields=[
+                ('job_id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('number', models.IntegerField()),
+                ('size', models.IntegerField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=16)),
+                ('key_ids', models.JSONField(default=list)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('kme', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='key_jobs', to='api.kme')),
+                ('master_sae', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='key_jobs', to='api.sae')),
+                ('target_saes', models.ManyToManyField(related_name='target_key_jobs', to='api.sae')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created_at'], name='api_keygene_status_aaeef1_idx')],
+            },
+        ),
+    ]
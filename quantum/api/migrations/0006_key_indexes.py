@@ -0,0 +1,25 @@
+# Generated by Django 5.1.1 on 2026-10-18 19:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_key_generation_job'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='key',
+            index=models.Index(fields=['origin_sae', 'created_at'], name='api_key_origin__618fc3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='keydelivery',
+            index=models.Index(fields=['sae', 'keymaterial'], name='api_keymate_sae_id_ad4712_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='keymaterial',
+            index=models.Index(fields=['created_at'], name='api_keymate_created_1a89ae_idx'),
+        ),
+    ]
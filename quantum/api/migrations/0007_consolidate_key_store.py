@@ -0,0 +1,157 @@
+# Generated by Django 5.1.1 on 2026-10-18 19:41
+
+import base64
+
+import django.db.models.deletion
+import uuid
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import unpad
+from django.db import migrations, models
+
+
+def consolidate_keys(apps, schema_editor):
+    """
+    Moves every key into a single KeyMaterial row: binary ciphertext, KEK of its batch (one per
+    distinct AES key and mode), KME, master SAE and size from the former Key row, and the
+    slave SAEs of Key.target_saes merged into the consult_by (KeyDelivery) table.
+    """
+    KeyMaterial = apps.get_model('api', 'KeyMaterial')
+    Key = apps.get_model('api', 'Key')
+    KeyDelivery = apps.get_model('api', 'KeyDelivery')
+    KeyEncryptionKey = apps.get_model('api', 'KeyEncryptionKey')
+    SAE = apps.get_model('api', 'SAE')
+
+    sae_kmes = dict(SAE.objects.values_list('sae_id', 'kme_id'))
+    keys = Key.objects.in_bulk()
+    key_material_ids = set(KeyMaterial.objects.values_list('key_id', flat=True))
+    deliveries = {}
+    for keymaterial_id, sae_id in KeyDelivery.objects.values_list('keymaterial_id', 'sae_id'):
+        deliveries.setdefault(keymaterial_id, []).append(sae_id)
+    for key_id, sae_id in Key.target_saes.through.objects.values_list('key_id', 'sae_id'):
+        if key_id in key_material_ids and sae_id not in deliveries.setdefault(key_id, []):
+            deliveries[key_id].append(sae_id)
+            KeyDelivery.objects.create(keymaterial_id=key_id, sae_id=sae_id)
+
+    keks = {}
+    orphans = []
+    for key_material in KeyMaterial.objects.all():
+        key = keys.get(key_material.key_id)
+        slave_saes = deliveries.get(key_material.key_id)
+        if key is None and not slave_saes:
+            orphans.append(key_material.key_id)  # Nobody can consult the key.
+            continue
+
+        mode = 'CBC' if key_material.iv else 'GCM'
+        aes_key = base64.b64decode(key_material.aes_key)
+        if (aes_key, mode) not in keks:
+            keks[aes_key, mode] = KeyEncryptionKey.objects.create(key=aes_key, mode=mode)
+        key_material.kek = keks[aes_key, mode]
+        key_material.ciphertext = base64.b64decode(key_material.encrypted_key)
+
+        if key is not None:
+            # Keys generated on this KME are accounted in the KME of their master SAE.
+            key_material.origin_sae_id = key.origin_sae_id
+            key_material.kme_id = sae_kmes[key.origin_sae_id]
+            key_material.size = key.size
+        else:
+            # Keys relayed by a peer KME are accounted in the KME of their slave SAE.
+            key_material.kme_id = sae_kmes[slave_saes[0]]
+            ciphertext = key_material.ciphertext
+            if mode == 'CBC':
+                cipher = AES.new(aes_key, AES.MODE_CBC, ciphertext[:AES.block_size])
+                size = len(unpad(cipher.decrypt(ciphertext[AES.block_size:]), AES.block_size))
+            else:
+                size = len(ciphertext) - 12 - 16  # Nonce and tag.
+            key_material.size = size * 8
+        key_material.save(update_fields=['kek', 'ciphertext', 'origin_sae', 'kme', 'size'])
+
+    KeyMaterial.objects.filter(key_id__in=orphans).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_key_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KeyEncryptionKey',
+            fields=[
+                ('kek_id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('key', models.BinaryField()),
+                ('mode', models.CharField(default='CBC', max_length=3)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='keymaterial',
+            name='kek',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='keys',
+                                    to='api.keyencryptionkey'),
+        ),
+        migrations.AddField(
+            model_name='keymaterial',
+            name='kme',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='keys',
+                                    to='api.kme'),
+        ),
+        migrations.AddField(
+            model_name='keymaterial',
+            name='origin_sae',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE,
+                                    related_name='origin_keys', to='api.sae'),
+        ),
+        migrations.AddField(
+            model_name='keymaterial',
+            name='size',
+            field=models.IntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='keymaterial',
+            name='ciphertext',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.RunPython(consolidate_keys),
+        migrations.RemoveField(
+            model_name='keymaterial',
+            name='encrypted_key',
+        ),
+        migrations.RemoveField(
+            model_name='keymaterial',
+            name='aes_key',
+        ),
+        migrations.RemoveField(
+            model_name='keymaterial',
+            name='iv',
+        ),
+        migrations.RenameField(
+            model_name='keymaterial',
+            old_name='ciphertext',
+            new_name='encrypted_key',
+        ),
+        migrations.AlterField(
+            model_name='keymaterial',
+            name='encrypted_key',
+            field=models.BinaryField(),
+        ),
+        migrations.AlterField(
+            model_name='keymaterial',
+            name='kek',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='keys',
+                                    to='api.keyencryptionkey'),
+        ),
+        migrations.AlterField(
+            model_name='keymaterial',
+            name='kme',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='keys', to='api.kme'),
+        ),
+        migrations.DeleteModel(
+            name='Key',
+        ),
+        migrations.AddIndex(
+            model_name='keymaterial',
+            index=models.Index(fields=['origin_sae', 'created_at'], name='api_keymate_origin__5bcccc_idx'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.1.1 on 2026-10-18 19:52
+
+import base64
+
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import migrations, models
+
+
+def get_master_key():
+    # Same as api.kek.get_master_key.
+    if not settings.KEK_MASTER_KEY:
+        raise ImproperlyConfigured("KEK_MASTER_KEY must be set when DEBUG is off.")
+    return base64.b64decode(settings.KEK_MASTER_KEY)
+
+
+def wrap_keks(apps, schema_editor):
+    """Wrap the AES key of every KEK under the master key (AES-GCM bound to the KEK ID)."""
+    KeyEncryptionKey = apps.get_model('api', 'KeyEncryptionKey')
+    master_key = get_master_key()
+    for kek in KeyEncryptionKey.objects.all():
+        cipher = AES.new(master_key, AES.MODE_GCM, nonce=get_random_bytes(12))
+        cipher.update(kek.kek_id.bytes)
+        ct_bytes, tag = cipher.encrypt_and_digest(bytes(kek.key))
+        kek.wrapped_key = cipher.nonce + ct_bytes + tag
+        kek.save(update_fields=['wrapped_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_consolidate_key_store'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='keyencryptionkey',
+            name='wrapped_key',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.RunPython(wrap_keks),
+        migrations.RemoveField(
+            model_name='keyencryptionkey',
+            name='key',
+        ),
+        migrations.AlterField(
+            model_name='keyencryptionkey',
+            name='wrapped_key',
+            field=models.BinaryField(),
+        ),
+    ]
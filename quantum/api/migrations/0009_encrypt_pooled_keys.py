@@ -0,0 +1,47 @@
+# Generated by Django 5.1.1 on 2026-10-18 21:04
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def drop_plaintext_pooled_keys(apps, schema_editor):
+    """The pooled keys were stored in plaintext: drop them, refill_key_pool generates encrypted ones."""
+    PooledKey = apps.get_model('api', 'PooledKey')
+    PooledKey.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_wrap_key_encryption_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pooledkey',
+            name='encrypted_key',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='pooledkey',
+            name='kek',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT,
+                                    related_name='pooled_keys', to='api.keyencryptionkey'),
+        ),
+        migrations.RunPython(drop_plaintext_pooled_keys),
+        migrations.RemoveField(
+            model_name='pooledkey',
+            name='key',
+        ),
+        migrations.AlterField(
+            model_name='pooledkey',
+            name='encrypted_key',
+            field=models.BinaryField(),
+        ),
+        migrations.AlterField(
+            model_name='pooledkey',
+            name='kek',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='pooled_keys',
+                                    to='api.keyencryptionkey'),
+        ),
+    ]
@@ -0,0 +1,89 @@
+# Generated by Django 5.1.1 on 2026-10-18 21:18
+
+import base64
+
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+from Crypto.Util.Padding import pad, unpad
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import migrations
+
+GCM_NONCE_SIZE = 12
+GCM_TAG_SIZE = 16
+
+
+def get_master_key():
+    # Same as api.kek.get_master_key.
+    if not settings.KEK_MASTER_KEY:
+        raise ImproperlyConfigured("KEK_MASTER_KEY must be set when DEBUG is off.")
+    return base64.b64decode(settings.KEK_MASTER_KEY)
+
+
+def unwrap_key(master_key, kek):
+    wrapped_key = bytes(kek.wrapped_key)
+    cipher = AES.new(master_key, AES.MODE_GCM, nonce=wrapped_key[:GCM_NONCE_SIZE])
+    cipher.update(kek.kek_id.bytes)
+    return cipher.decrypt_and_verify(wrapped_key[GCM_NONCE_SIZE:-GCM_TAG_SIZE], wrapped_key[-GCM_TAG_SIZE:])
+
+
+def decrypt(encrypted_key, aes_key, mode):
+    if mode == 'GCM':
+        cipher = AES.new(aes_key, AES.MODE_GCM, nonce=encrypted_key[:GCM_NONCE_SIZE])
+        return cipher.decrypt_and_verify(encrypted_key[GCM_NONCE_SIZE:-GCM_TAG_SIZE], encrypted_key[-GCM_TAG_SIZE:])
+    cipher = AES.new(aes_key, AES.MODE_CBC, encrypted_key[:AES.block_size])
+    return unpad(cipher.decrypt(encrypted_key[AES.block_size:]), AES.block_size)
+
+
+def encrypt(key, aes_key, mode):
+    if mode == 'GCM':
+        cipher = AES.new(aes_key, AES.MODE_GCM, nonce=get_random_bytes(GCM_NONCE_SIZE))
+        ct_bytes, tag = cipher.encrypt_and_digest(key)
+        return cipher.nonce + ct_bytes + tag
+    cipher = AES.new(aes_key, AES.MODE_CBC)
+    return cipher.iv + cipher.encrypt(pad(key, AES.block_size))
+
+
+def is_legacy_key(key, size):
+    """
+    Keys stored before the keys were packed into bytes are ASCII strings of '0' and '1',
+    one character per bit: their length is their size in bits (or at least 8 characters for
+    the relayed keys, whose size was computed from their length in bytes).
+    """
+    return bool(key) and not key.strip(b'01') and (len(key) == size or len(key) >= 8)
+
+
+def pack_legacy_keys(apps, schema_editor):
+    """Re-encrypt the keys stored as strings of '0' and '1' as packed bytes (most significant bit first)."""
+    KeyMaterial = apps.get_model('api', 'KeyMaterial')
+    master_key = get_master_key()
+
+    aes_keys = {}
+    for key_material in KeyMaterial.objects.select_related('kek').iterator():
+        kek = key_material.kek
+        if kek.kek_id not in aes_keys:
+            aes_keys[kek.kek_id] = unwrap_key(master_key, kek)
+        aes_key = aes_keys[kek.kek_id]
+
+        key = decrypt(bytes(key_material.encrypted_key), aes_key, kek.mode)
+        if not is_legacy_key(key, key_material.size):
+            continue
+
+        # Bit strings whose length is not a multiple of 8 are padded with zeros.
+        bits = key.decode('ascii')
+        padding = -len(bits) % 8
+        packed = (int(bits, 2) << padding).to_bytes((len(bits) + padding) // 8, 'big')
+        key_material.encrypted_key = encrypt(packed, aes_key, kek.mode)
+        key_material.size = len(bits)
+        key_material.save(update_fields=['encrypted_key', 'size'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_encrypt_pooled_keys'),
+    ]
+
+    operations = [
+        migrations.RunPython(pack_legacy_keys),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-18 21:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_pack_legacy_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='kmeconnection',
+            name='relay_secret',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-18 22:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_kmeconnection_relay_secret'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='keymaterial',
+            name='decrypted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
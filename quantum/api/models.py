@@ -1,6 +1,5 @@
 import uuid
 
-from Crypto.Random import get_random_bytes
 from django.db import models
 from django.contrib.auth.models import User
 
@@ -40,47 +39,152 @@ class SAE(models.Model):
         return f"SAE- {self.name}: {self.sae_id}"
 
 
-class Key(models.Model):
+class KMEConnection(models.Model):
+    source_kme = models.ForeignKey(KME, related_name='outgoing_connections', on_delete=models.CASCADE)
+    target_kme = models.ForeignKey(KME, related_name='incoming_connections', on_delete=models.CASCADE)
+    connection_certificate = models.BinaryField(null=True, blank=True)
+    # Secret shared by the two KMEs, signing the keys relayed from the source to the target (see api.relay).
+    relay_secret = models.BinaryField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Connection from {self.source_kme} to {self.target_kme}"
+
+
+class KeyEncryptionKey(models.Model):
+    """
+    AES key encrypting the keys of a generation batch (key-encryption key, KEK).
+    The AES key is stored wrapped under the master key (see api.kek).
+    """
+    kek_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    wrapped_key = models.BinaryField()  # The AES key, encrypted with the master key.
+    mode = models.CharField(max_length=3, default='CBC')  # AES mode of the batch: 'CBC' or 'GCM'.
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"KEK {self.kek_id} ({self.mode})"
+
+
+class KeyMaterial(models.Model):
     """
-    Model for keys assigned between source SAE and target SAE.
+    Key stored by a KME, encrypted with the KEK of its batch. One row per key, shared with
+    the SAEs allowed to consult it through KeyDelivery.
     """
-    key_id = models.UUIDField(primary_key=True, default=uuid.uuid4, unique=True, editable=False)
-    key_data = models.BinaryField()
-    origin_sae = models.ForeignKey(SAE, related_name='origin_keys', on_delete=models.CASCADE)  # Master SAE.
-    target_saes = models.ManyToManyField(SAE, related_name='target_keys')  # Slave SAEs.
+    key_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, unique=True)
+    encrypted_key = models.BinaryField()  # IV + ciphertext (CBC) or nonce + ciphertext + tag (GCM).
+    kek = models.ForeignKey(KeyEncryptionKey, related_name='keys', on_delete=models.PROTECT)
+    kme = models.ForeignKey(KME, related_name='keys', on_delete=models.CASCADE)  # KME whose storage the key uses.
+    # Master SAE, unknown for the keys relayed by a peer KME.
+    origin_sae = models.ForeignKey(SAE, related_name='origin_keys', null=True, blank=True, on_delete=models.CASCADE)
+    size = models.IntegerField()  # Size in bits.
+    consult_by = models.ManyToManyField(SAE, related_name='consulted_keys', through='KeyDelivery')
     created_at = models.DateTimeField(auto_now_add=True)
-    size = models.IntegerField(default=352)
+    decrypted_at = models.DateTimeField(null=True, blank=True)  # Set when dec_keys first returns the key in plaintext.
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at']),
+            models.Index(fields=['origin_sae', 'created_at']),  # Keys of a master SAE, oldest first.
+        ]
 
     def __str__(self):
         return f"Key {self.key_id} (size: {self.size} bits)"
 
 
-class KMEConnection(models.Model):
-    source_kme = models.ForeignKey(KME, related_name='outgoing_connections', on_delete=models.CASCADE)
-    target_kme = models.ForeignKey(KME, related_name='incoming_connections', on_delete=models.CASCADE)
-    connection_certificate = models.BinaryField(null=True, blank=True)
+class KeyDelivery(models.Model):
+    """
+    Queue entry of a key for an SAE allowed to consult it. The entry is consumed once the SAE has claimed
+    the key (enc_keys GET with number=N) or retrieved it with dec_keys.
+    """
+    keymaterial = models.ForeignKey(KeyMaterial, related_name='deliveries', on_delete=models.CASCADE)
+    sae = models.ForeignKey(SAE, related_name='key_deliveries', on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+    consumed_at = models.DateTimeField(null=True, blank=True)  # Set when the key is claimed by or delivered to the SAE.
+
+    class Meta:
+        db_table = 'api_keymaterial_consult_by'  # Former auto-created table of KeyMaterial.consult_by.
+        unique_together = [('keymaterial', 'sae')]
+        indexes = [
+            # Queue of the unconsumed keys of an SAE, in delivery order.
+            models.Index(fields=['sae', 'created_at', 'id'], condition=models.Q(consumed_at__isnull=True),
+                         name='api_keydelivery_queue_idx'),
+            # Keys an SAE may consult (dec_keys), without reading the table.
+            models.Index(fields=['sae', 'keymaterial']),
+        ]
+
+
+class KeyPool(models.Model):
+    """
+    Pool of pre-generated sifted keys of a KME, refilled in the background between watermarks.
+    """
+    kme = models.OneToOneField(KME, related_name='key_pool', on_delete=models.CASCADE, primary_key=True)
+    hits = models.IntegerField(default=0)  # Requests served from the pool.
+    misses = models.IntegerField(default=0)  # Requests that fell back to on-demand generation.
+    refilled_key_count = models.IntegerField(default=0)  # Keys added by the refill worker.
+    refill_rate = models.FloatField(default=0)  # Keys per second of the last refill.
+    last_refill_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
-        return f"Connection from {self.source_kme} to {self.target_kme}"
+        return f"Key pool of {self.kme}"
 
 
-class KeyMaterial(models.Model):
-    key_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, unique=True)
-    encrypted_key = models.TextField()  # The encrypted key (in base64)
-    aes_key = models.TextField(default=get_random_bytes(16))
-    iv = models.TextField()  # The AES initialization vector.
-    consult_by = models.ManyToManyField(SAE, related_name='consulted_keys')
+class PooledKey(models.Model):
+    """
+    Pre-generated key of a pool, encrypted with the KEK of its refill batch.
+    """
+    pool = models.ForeignKey(KeyPool, related_name='keys', on_delete=models.CASCADE)
+    encrypted_key = models.BinaryField()  # The key packed into bytes, encrypted like KeyMaterial.encrypted_key.
+    kek = models.ForeignKey(KeyEncryptionKey, related_name='pooled_keys', on_delete=models.PROTECT)
+    # Key size requested at generation, in bits: the size of the key with BB84_EXACT_KEYS
+    # (the default), about half of it otherwise (the sifted keys of generate_bb84_keys).
+    size = models.IntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
 
 
+class KeyGenerationJob(models.Model):
+    """
+    Key generation request processed in the background (enc_keys POST with "async": true).
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    job_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kme = models.ForeignKey(KME, related_name='key_jobs', on_delete=models.CASCADE)
+    master_sae = models.ForeignKey(SAE, related_name='key_jobs', on_delete=models.CASCADE)
+    target_saes = models.ManyToManyField(SAE, related_name='target_key_jobs')
+    number = models.IntegerField()  # Number of keys requested.
+    size = models.IntegerField()  # Key size requested, in bits.
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    key_ids = models.JSONField(default=list)  # IDs of the keys stored so far.
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'created_at'])]
+
+    def __str__(self):
+        return f"Key job {self.job_id} ({self.status}: {len(self.key_ids)}/{self.number} keys)"
+
+
 def update_sae_communication(master_sae, slave_sae):
     """
     Updates the communication relationships between master SAE and slave SAE.
+    The pairings are compared in the database, not with the given SAEs, which may come from the
+    topology cache of this process: only the SAEs whose pairing actually changed are written.
     """
-    master_sae.communicates_with = slave_sae
-    slave_sae.communicates_with = master_sae
-    master_sae.save()
-    slave_sae.save()
+    from .topology import clear_topology_cache  # The topology cache imports the models.
+
+    updated = 0
+    for sae, partner in ((master_sae, slave_sae), (slave_sae, master_sae)):
+        updated += (SAE.objects.filter(sae_id=sae.sae_id)
+                    .exclude(communicates_with=partner)
+                    .update(communicates_with=partner))
+    if updated:
+        # update() sends no post_save signal: drop the cached pairings of this process.
+        clear_topology_cache()
 
 
 
@@ -0,0 +1,70 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from Crypto.Random import get_random_bytes
+from django.conf import settings
+
+from .keygen import get_executor, generate_encrypted_keys
+from .relay import KeyRelayBatch
+from .reservoir import link_id
+from .service import delete_stored_keys, store_generated_keys, release_key_capacity
+
+
+def generate_and_relay_keys(key_request):
+    """
+    Generates keys for SAEs of peer KMEs, stores them locally and relays them to the peers.
+    The locally stored keys are purged once the master SAE and the local slave SAEs consumed them.
+
+    The keys go through the stages chunk by chunk (KME_RELAY_CHUNK_SIZE keys) so that
+    the stages overlap: while chunk i is stored on this KME, chunk i + 1 is generated and
+    encrypted in the key generation process pool and chunk i - 1 is relayed by a
+    background thread. Returns the stored keys.
+    """
+    kme = key_request['kme']
+    number_of_keys = key_request['number']
+    target_saes = key_request['target_saes']
+    peer_saes = [sae for sae in target_saes if sae.kme_id != kme.kme_id]
+    # The SAEs of peer KMEs consume the keys from their own KME: the local queue entries are those of the
+    # local slave SAEs and of the master SAE, consumed when it retrieves the keys (dec_keys).
+    local_saes = [sae for sae in target_saes if sae.kme_id == kme.kme_id] + [key_request['master_sae']]
+    aes_key = get_random_bytes(16)
+    mode = settings.KEY_ENCRYPTION_MODE
+    link = link_id(kme, key_request['kme_slave'])
+
+    chunk_size = settings.KME_RELAY_CHUNK_SIZE
+    chunks = [min(chunk_size, number_of_keys - start) for start in range(0, number_of_keys, chunk_size)]
+
+    def generate(number):
+        return get_executor().submit(generate_encrypted_keys, number, key_request['size'], aes_key,
+                                     settings.BB84_ENGINE, mode, link)
+
+    stored_keys = []
+    relays = []
+    relay_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='key-relay')
+    try:
+        generation = generate(chunks[0])
+        for index in range(len(chunks)):
+            keys, encrypted_keys = generation.result(timeout=settings.KEYGEN_TIMEOUT)
+            if index + 1 < len(chunks):
+                generation = generate(chunks[index + 1])
+
+            chunk_keys = store_generated_keys(keys, aes_key, key_request['master_sae'], local_saes, encrypted_keys)
+            stored_keys += chunk_keys
+
+            batch = KeyRelayBatch(kme, key_request['relay_secrets'])
+            for sae in peer_saes:
+                batch.add(sae.kme, sae, chunk_keys, aes_key, mode)
+            relays.append(relay_thread.submit(batch.send))
+
+        # Wait for the last relays, raising the first relay error.
+        for relay in relays:
+            relay.result()
+    except Exception:
+        # The master SAE gets no key ID: delete the keys stored so far, which it could never
+        # retrieve, and give back the storage reserved for the whole request.
+        delete_stored_keys([key['key_ID'] for key in stored_keys])
+        release_key_capacity(kme, number_of_keys)
+        raise
+    finally:
+        relay_thread.shutdown(wait=False, cancel_futures=True)
+
+    return stored_keys
@@ -0,0 +1,119 @@
+import time
+
+from Crypto.Random import get_random_bytes
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .encryptor import encrypt_keys_aes
+from .kek import create_kek
+from .reservoir import generate_keys, link_id
+from .models import KeyPool, PooledKey
+from .service import decrypt_key_materials
+
+
+def get_key_pool(kme):
+    """Retrieve the key pool of a KME, creating it on first use."""
+    pool, _ = KeyPool.objects.get_or_create(kme=kme)
+    return pool
+
+
+def pool_key_sizes(kme):
+    """Key sizes (bits) pre-generated in the pool of a KME: KEY_POOL_KEY_SIZES, or the KME key size."""
+    return settings.KEY_POOL_KEY_SIZES or [kme.key_size]
+
+
+def pool_capacity(kme, size):
+    """
+    Number of keys of a size the pool of a KME may hold.
+    Each pool key size gets an equal share of the KEY_POOL_MAX_BITS budget, and the
+    pool never holds more keys of a size than the KME may still store.
+    """
+    capacity = settings.KEY_POOL_MAX_BITS // len(pool_key_sizes(kme)) // max(size, 1)
+    return max(min(capacity, kme.max_key_count - kme.stored_key_count), 0)
+
+
+def refill_key_pool(kme):
+    """
+    Top up the key pool of a KME with keys of each pool key size.
+    Nothing is generated for a size while its keys are above the low watermark; otherwise they
+    are filled up to the high watermark. The keys of each generated batch are stored encrypted
+    with a new KEK, like the stored keys. Returns the number of keys added.
+    """
+    pool = get_key_pool(kme)
+    added = 0
+    start = time.monotonic()
+    for size in pool_key_sizes(kme):
+        capacity = pool_capacity(kme, size)
+        available = pool.keys.filter(size=size).count()
+        if available > capacity * settings.KEY_POOL_LOW_WATERMARK:
+            continue
+
+        missing = int(capacity * settings.KEY_POOL_HIGH_WATERMARK) - available
+        while missing > 0:
+            # Generate in batches of at most one request worth of keys.
+            number = min(missing, kme.max_key_per_request)
+            keys = generate_keys(link_id(kme, kme), number, size)
+            aes_key = get_random_bytes(16)
+            kek = create_kek(aes_key, settings.KEY_ENCRYPTION_MODE)
+            encrypted_keys = encrypt_keys_aes(keys, aes_key, settings.KEY_ENCRYPTION_MODE)
+            with transaction.atomic():
+                kek.save(force_insert=True)
+                PooledKey.objects.bulk_create(
+                    PooledKey(pool=pool, encrypted_key=encrypted_key, kek=kek, size=size)
+                    for encrypted_key in encrypted_keys
+                )
+            added += number
+            missing -= number
+    elapsed = time.monotonic() - start
+
+    KeyPool.objects.filter(pk=pool.pk).update(
+        refilled_key_count=F('refilled_key_count') + added,
+        refill_rate=added / elapsed if elapsed else 0,
+        last_refill_at=timezone.now(),
+    )
+    return added
+
+
+def take_pooled_keys(kme, number, size):
+    """
+    Pop keys of the requested size from the pool of a KME.
+    Returns the decrypted keys as bytes, or None (a miss) if the pool cannot serve the whole request.
+    """
+    pool = get_key_pool(kme)
+
+    with transaction.atomic():
+        pooled = PooledKey.objects.filter(pool=pool, size=size).order_by('id')
+        if connection.features.has_select_for_update_skip_locked:
+            pooled = pooled.select_for_update(skip_locked=True)
+        pooled = list(pooled[:number])
+
+        if len(pooled) < number:
+            KeyPool.objects.filter(pk=pool.pk).update(misses=F('misses') + 1)
+            return None
+
+        PooledKey.objects.filter(id__in=[key.id for key in pooled]).delete()
+        KeyPool.objects.filter(pk=pool.pk).update(hits=F('hits') + 1)
+
+    return decrypt_key_materials(pooled)
+
+
+def key_pool_status(kme):
+    """Fill level and counters of the key pool of a KME."""
+    pool = get_key_pool(kme)
+    sizes = pool_key_sizes(kme)
+    capacity = sum(pool_capacity(kme, size) for size in sizes)
+    available = pool.keys.filter(size__in=sizes).count()
+    return {
+        "KME_ID": kme.kme_id,
+        "key_sizes": sizes,
+        "available_key_count": available,
+        "capacity": capacity,
+        "fill_level": available / capacity if capacity else 0,
+        "refilled_key_count": pool.refilled_key_count,
+        "refill_rate": pool.refill_rate,
+        "last_refill_at": pool.last_refill_at,
+        "hits": pool.hits,
+        "misses": pool.misses,
+    }
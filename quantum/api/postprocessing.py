@@ -0,0 +1,88 @@
+import numpy as np
+
+
+class QBERTooHigh(Exception):
+    """
+    Raised when the estimated quantum bit error rate reveals a too noisy or eavesdropped channel.
+    It is a failure of the channel, not of the request.
+    """
+
+
+def binary_entropy(p):
+    """Binary entropy h(p) in bits, element-wise, with h(0) = h(1) = 0."""
+    p = np.asarray(p, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        entropy = -p * np.log2(p) - (1 - p) * np.log2(1 - p)
+    return np.where((p == 0) | (p == 1), 0.0, entropy)
+
+
+def estimate_qber(alice_bits, bob_bits, sample_size, rng=None):
+    """
+    Estimate the QBER of each block of a batch from a sample of its bits disclosed by Alice and Bob.
+
+    alice_bits and bob_bits have the shape (num_blocks, block_bits). Each block sacrifices
+    sample_size bits at random positions. Returns the estimated QBER of each block and the
+    remaining (undisclosed) bits of Alice and Bob, of shape (num_blocks, block_bits - sample_size).
+    """
+    rng = rng or np.random.default_rng()
+    num_blocks, block_bits = alice_bits.shape
+
+    # Random positions for every block at once: the sample is the start of a random permutation.
+    permutation = rng.random((num_blocks, block_bits)).argsort(axis=1)
+    sample, kept = permutation[:, :sample_size], np.sort(permutation[:, sample_size:], axis=1)
+
+    errors = np.take_along_axis(alice_bits, sample, axis=1) != np.take_along_axis(bob_bits, sample, axis=1)
+    qber = errors.mean(axis=1) if sample_size else np.zeros(num_blocks)
+    return qber, np.take_along_axis(alice_bits, kept, axis=1), np.take_along_axis(bob_bits, kept, axis=1)
+
+
+def secure_key_length(block_bits, qber, security_bits):
+    """
+    Length of the amplified key of a block with the asymptotic BB84 rate 1 - 2 h(QBER):
+    h(QBER) for the information leaked by error correction and h(QBER) for the eavesdropper,
+    minus a security margin. Element-wise over the QBER of the blocks.
+    """
+    length = np.floor(block_bits * (1 - 2 * binary_entropy(qber))) - security_bits
+    return np.maximum(length, 0).astype(np.int64)
+
+
+def toeplitz_hash(bits, output_bits, seeds):
+    """
+    Multiply each block by its binary Toeplitz matrix modulo 2, for the whole batch at once.
+
+    bits has the shape (num_blocks, n), seeds the shape (num_blocks, n + output_bits - 1): the seed
+    of a block is the first row and column of its output_bits x n Toeplitz matrix T, T[i, j] =
+    seed[i - j + n - 1]. T x is the slice [n - 1, n - 1 + output_bits) of the convolution of the seed
+    with x, computed with real FFTs in O(n log n) per block.
+    """
+    num_blocks, n = bits.shape
+    size = 1 << (2 * n + output_bits - 2).bit_length()  # Room for the linear convolution.
+
+    spectrum = np.fft.rfft(seeds, size, axis=1) * np.fft.rfft(bits, size, axis=1)
+    convolution = np.fft.irfft(spectrum, size, axis=1)[:, n - 1:n - 1 + output_bits]
+    # The convolution values are integers up to n, exactly recovered by rounding.
+    return (np.rint(convolution).astype(np.int64) & 1).astype(np.uint8)
+
+
+def amplify_privacy(alice_bits, bob_bits, sample_size, qber_threshold, security_bits, rng=None):
+    """
+    Post-process a batch of sifted blocks: estimate their QBER, then compress the
+    undisclosed bits with Toeplitz hashing to their secure length.
+
+    Raises QBERTooHigh if the QBER of a block exceeds qber_threshold. Returns the amplified bits
+    of Alice (Bob's are identical once the errors are corrected: error correction is not simulated,
+    only its leakage is accounted for) as one array, and the QBER of each block.
+    """
+    rng = rng or np.random.default_rng()
+    qber, alice_kept, _ = estimate_qber(alice_bits, bob_bits, sample_size, rng)
+    if (qber > qber_threshold).any():
+        raise QBERTooHigh(f"QBER of {qber.max():.1%} above the {qber_threshold:.1%} threshold")
+
+    # The blocks are hashed to the length allowed by the worst QBER of the batch.
+    n = alice_kept.shape[1]
+    output_bits = int(secure_key_length(n, qber.max(), security_bits))
+    if not output_bits:
+        return np.empty(0, dtype=np.uint8), qber
+
+    seeds = rng.integers(0, 2, size=(alice_kept.shape[0], n + output_bits - 1), dtype=np.uint8)
+    return toeplitz_hash(alice_kept, output_bits, seeds).ravel(), qber
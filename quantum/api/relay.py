@@ -0,0 +1,157 @@
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import time
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .models import KMEConnection
+
+# Path of the endpoint of the peer KMEs receiving the relayed keys.
+RELAY_PATH = '/api/v1/keys/enc_keys/'
+
+# Headers authenticating a relay: HMAC-SHA256 of the timestamp and the body, with the relay secret.
+SIGNATURE_HEADER = 'X-KME-Signature'
+TIMESTAMP_HEADER = 'X-KME-Timestamp'
+
+# One keep-alive session (and connection pool) per peer KME base URL.
+_peer_sessions = {}
+_peer_sessions_lock = threading.Lock()
+
+
+def peer_url(kme):
+    """Base URL of a peer KME, from its hostname (HTTPS unless a scheme is given)."""
+    hostname = kme.hostname.rstrip('/')
+    return hostname if '://' in hostname else f"https://{hostname}"
+
+
+def get_peer_session(kme):
+    """
+    Retrieve the HTTP session of a peer KME, creating it on first use.
+    The session keeps its connections alive and retries failed requests with an exponential backoff.
+    """
+    url = peer_url(kme)
+    with _peer_sessions_lock:
+        session = _peer_sessions.get(url)
+        if session is None:
+            retry = Retry(
+                total=settings.KME_RELAY_RETRIES,
+                backoff_factor=settings.KME_RELAY_BACKOFF,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=None,  # The relayed keys are ingested idempotently, POST may be retried.
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.KME_RELAY_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _peer_sessions[url] = session
+        return session
+
+
+def close_peer_sessions():
+    """Close the sessions of all the peer KMEs."""
+    with _peer_sessions_lock:
+        for session in _peer_sessions.values():
+            session.close()
+        _peer_sessions.clear()
+
+
+def get_relay_secrets(source_kme, target_kmes):
+    """
+    Relay secrets of the connections from a KME to other KMEs, in a single query.
+    Returns a dict target kme_id -> secret, without the KMEs that share no secret.
+    """
+    connections = (KMEConnection.objects
+                   .filter(source_kme=source_kme, target_kme__in=list(target_kmes), relay_secret__isnull=False)
+                   .values_list('target_kme_id', 'relay_secret'))
+    return {kme_id: bytes(secret) for kme_id, secret in connections if secret}
+
+
+def sign_relay(secret, timestamp, body):
+    """Signature of a relayed body: HMAC-SHA256 of the timestamp and the body, in hexadecimal."""
+    return hmac.new(secret, f"{timestamp}.".encode() + body, hashlib.sha256).hexdigest()
+
+
+def relay_headers(secret, body, timestamp=None):
+    """Headers signing a relayed body with the relay secret shared with the peer KME."""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    return {
+        'Content-Type': 'application/json',
+        TIMESTAMP_HEADER: str(timestamp),
+        SIGNATURE_HEADER: sign_relay(secret, timestamp, body),
+    }
+
+
+def verify_relay(secret, headers, body):
+    """
+    Check the signature of a relayed body with the relay secret shared with its source KME.
+    Signatures older (or newer) than KME_RELAY_SIGNATURE_MAX_AGE seconds are rejected, so a
+    captured relay cannot be replayed once its keys are consumed and purged.
+    """
+    try:
+        timestamp = int(headers.get(TIMESTAMP_HEADER, ''))
+    except ValueError:
+        return False
+    if not secret or abs(time.time() - timestamp) > settings.KME_RELAY_SIGNATURE_MAX_AGE:
+        return False
+    return hmac.compare_digest(sign_relay(secret, timestamp, body), headers.get(SIGNATURE_HEADER, ''))
+
+
+def post_to_peer(kme, payload, secret):
+    """
+    Send a payload of relayed keys to a peer KME, signed with their relay secret, with bounded
+    connect and read timeouts.
+    Raises requests.RequestException if the peer cannot be reached after the retries.
+    """
+    body = json.dumps(payload).encode()
+    return get_peer_session(kme).post(
+        f"{peer_url(kme)}{RELAY_PATH}",
+        data=body,
+        headers=relay_headers(secret, body),
+        timeout=(settings.KME_RELAY_CONNECT_TIMEOUT, settings.KME_RELAY_READ_TIMEOUT),
+    )
+
+
+def relay_payload(source_kme, sae_slave, stored_keys, aes_key, mode='CBC'):
+    """Payload relaying keys stored for a slave SAE, with the AES key and mode they are encrypted with."""
+    return {
+        "source_KME_ID": str(source_kme.kme_id),
+        "sae_slave_id": str(sae_slave.sae_id),
+        "keys": stored_keys,
+        "aes_key": base64.b64encode(aes_key).decode('utf-8'),
+        "mode": mode,
+    }
+
+
+class KeyRelayBatch:
+    """
+    Coalesces the keys bound for the same peer KME and sends them as a single payload per peer.
+    """
+
+    def __init__(self, source_kme, secrets):
+        self.source_kme = source_kme  # The KME sending the keys.
+        self.secrets = secrets  # kme_id -> relay secret shared with the peer KME (see get_relay_secrets).
+        self._peers = {}  # kme_id -> (KME, payloads)
+
+    def add(self, kme_slave, sae_slave, stored_keys, aes_key, mode='CBC'):
+        """Queue keys for a slave SAE of a peer KME."""
+        _, payloads = self._peers.setdefault(kme_slave.kme_id, (kme_slave, []))
+        payloads.append(relay_payload(self.source_kme, sae_slave, stored_keys, aes_key, mode))
+
+    def send(self):
+        """
+        Send the queued keys, one request per peer KME. Returns the responses by KME ID.
+        Raises requests.HTTPError if a peer rejects its keys.
+        """
+        responses = {}
+        for kme_id, (kme_slave, payloads) in self._peers.items():
+            responses[kme_id] = post_to_peer(kme_slave, {"batches": payloads}, self.secrets[kme_id])
+            responses[kme_id].raise_for_status()
+        self._peers.clear()
+        return responses
@@ -0,0 +1,105 @@
+import threading
+
+import numpy as np
+from django.conf import settings
+
+from .bb84 import generate_bb84_keys, generate_sifted_bits, generate_sifted_pairs
+from .postprocessing import QBERTooHigh, amplify_privacy
+
+# In-process sifted-bit reservoirs, by KME link.
+_reservoirs = {}
+_reservoirs_lock = threading.Lock()
+
+
+def link_id(kme_master, kme_slave):
+    """Identifier of the link between the KME of a master SAE and the KME of a slave SAE."""
+    return f"{kme_master.kme_id}:{kme_slave.kme_id}"
+
+
+class SiftedBitReservoir:
+    """
+    Buffer of the sifted BB84 bits of a KME link, from which keys of an exact size are sliced.
+    The raw qubits are sent in whole circuits of BB84_CHUNK_QUBITS qubits and sifted (then
+    post-processed in whole blocks, see BB84_POSTPROCESSING): the bits left over by a request
+    are kept for the next one.
+    """
+
+    def __init__(self):
+        self.bits = np.empty(0, dtype=np.uint8)
+        self.lock = threading.Lock()
+
+    def take(self, num_bits, engine=None):
+        """Take exactly num_bits sifted bits, generating only the missing ones."""
+        with self.lock:
+            missing = num_bits - self.bits.size
+            if missing > 0 and settings.BB84_POSTPROCESSING:
+                self.bits = np.concatenate((self.bits, generate_amplified_bits(missing, engine)))
+            elif missing > 0:
+                self.bits = np.concatenate((self.bits, generate_sifted_bits(missing, engine)))
+
+            bits, self.bits = self.bits[:num_bits], self.bits[num_bits:]
+        return bits
+
+
+def generate_amplified_bits(num_bits, engine=None):
+    """
+    Generate at least num_bits secret bits: sifted blocks of BB84_PA_BLOCK_BITS bits go through
+    QBER estimation and privacy amplification, all the blocks of a round at once.
+    Raises QBERTooHigh if the channel is too noisy to produce a secret key.
+    """
+    block_bits = settings.BB84_PA_BLOCK_BITS
+    sample_size = int(block_bits * settings.BB84_QBER_SAMPLE)
+    # Output of a block on a noiseless channel: further rounds are only needed on noisy ones.
+    block_output = block_bits - sample_size - settings.BB84_PA_SECURITY_BITS
+
+    amplified = []
+    produced = 0
+    while produced < num_bits:
+        num_blocks = -(-(num_bits - produced) // block_output)
+        alice_bits, bob_bits = generate_sifted_pairs(num_blocks * block_bits, engine)
+        # Whole blocks only: the sifted bits beyond the last whole block are dropped.
+        num_blocks = alice_bits.size // block_bits
+        alice_bits, bob_bits = (bits[:num_blocks * block_bits].reshape(num_blocks, block_bits)
+                                for bits in (alice_bits, bob_bits))
+        bits, _ = amplify_privacy(alice_bits, bob_bits, sample_size, settings.BB84_QBER_THRESHOLD,
+                                  settings.BB84_PA_SECURITY_BITS)
+        if not bits.size:
+            raise QBERTooHigh("No secret bits left after privacy amplification")
+        amplified.append(bits)
+        produced += bits.size
+    return np.concatenate(amplified)
+
+
+def get_reservoir(link):
+    """Retrieve the sifted-bit reservoir of a KME link, creating it on first use."""
+    with _reservoirs_lock:
+        return _reservoirs.setdefault(link, SiftedBitReservoir())
+
+
+def clear_reservoirs():
+    """Drop the sifted-bit reservoirs of this process."""
+    with _reservoirs_lock:
+        _reservoirs.clear()
+
+
+def take_exact_keys(link, num_keys, num_bits_per_key, engine=None):
+    """
+    Generate num_keys keys of exactly num_bits_per_key bits from the reservoir of a KME link.
+    Returns the keys packed into bytes (most significant bit first).
+    """
+    if num_bits_per_key % 8 != 0:
+        raise ValueError("Key size must be a multiple of 8")
+
+    bits = get_reservoir(link).take(num_keys * num_bits_per_key, engine)
+    packed = np.packbits(bits).reshape(num_keys, num_bits_per_key // 8)
+    return [key.tobytes() for key in packed]
+
+
+def generate_keys(link, num_keys, num_bits_per_key, engine=None):
+    """
+    Generate the keys of a request on a KME link: keys of the exact requested size from the
+    link reservoir (BB84_EXACT_KEYS), or the sifted keys of generate_bb84_keys, of about half that size.
+    """
+    if settings.BB84_EXACT_KEYS:
+        return take_exact_keys(link, num_keys, num_bits_per_key, engine)
+    return generate_bb84_keys(num_keys=num_keys, num_bits_per_key=num_bits_per_key, engine=engine)
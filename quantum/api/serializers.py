@@ -1,8 +1,10 @@
+import base64
+
 from django.contrib.auth.models import User
 from rest_framework import serializers
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 
-from .models import KME, SAE, Key
+from .models import KME, SAE, KeyMaterial, KeyGenerationJob
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -47,15 +49,19 @@ class KMESerializer(serializers.ModelSerializer):
 
 class KeySerializer(serializers.ModelSerializer):
     """
-    Serializer for the Key entity.
+    Serializer for the stored keys (KeyMaterial).
     """
+    key_data = serializers.SerializerMethodField()  # Encrypted key, in base64.
     origin_sae = SAESerializer(read_only=True)  # Include the details of the master SAE.
-    target_saes = SAESerializer(many=True, read_only=True)  # Include the details of the slave SAEs.
+    target_saes = SAESerializer(source='consult_by', many=True, read_only=True)  # Include the details of the slave SAEs.
 
     class Meta:
-        model = Key
+        model = KeyMaterial
         fields = ['key_id', 'key_data', 'size', 'origin_sae', 'target_saes', 'created_at']
 
+    def get_key_data(self, key):
+        return base64.b64encode(key.encrypted_key).decode('utf-8')
+
 
 class StatusSerializer(serializers.Serializer):
     """
@@ -72,3 +78,38 @@ class StatusSerializer(serializers.Serializer):
     max_key_size = serializers.IntegerField()
     min_key_size = serializers.IntegerField()
     max_SAE_ID_count = serializers.IntegerField()
+
+
+class KeyPoolSerializer(serializers.Serializer):
+    """
+    Serializer for the GET /pool endpoint.
+    """
+    KME_ID = serializers.CharField()
+    key_sizes = serializers.ListField(child=serializers.IntegerField())
+    available_key_count = serializers.IntegerField()
+    capacity = serializers.IntegerField()
+    fill_level = serializers.FloatField()
+    refilled_key_count = serializers.IntegerField()
+    refill_rate = serializers.FloatField()
+    last_refill_at = serializers.DateTimeField(allow_null=True)
+    hits = serializers.IntegerField()
+    misses = serializers.IntegerField()
+
+
+class KeyJobSerializer(serializers.ModelSerializer):
+    """
+    Serializer for the asynchronous key generation jobs.
+    """
+    job_ID = serializers.UUIDField(source='job_id')
+    progress = serializers.SerializerMethodField()
+    keys = serializers.SerializerMethodField()
+
+    class Meta:
+        model = KeyGenerationJob
+        fields = ['job_ID', 'status', 'number', 'size', 'progress', 'keys', 'error', 'created_at', 'updated_at']
+
+    def get_progress(self, job):
+        return len(job.key_ids) / job.number if job.number else 1
+
+    def get_keys(self, job):
+        return [{"key_ID": key_id} for key_id in job.key_ids]
@@ -1,66 +1,235 @@
 import base64
+import binascii
+import json
 import uuid
-import requests
+from datetime import datetime
 
-from django.db import transaction
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, F, Q
+from django.db.models.functions import Greatest
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.response import Response
 
-from .models import KeyMaterial, Key, KMEConnection, KME, SAE
-from .encryptor import encrypt_key_aes, hash_key
+from .models import KeyMaterial, KeyDelivery, KeyEncryptionKey, KMEConnection, KME, SAE
+from .encryptor import encrypt_keys_aes, decrypt_keys_aes
+from .kek import create_kek, get_keks
+from .metrics import stage
 
 
-def store_generated_keys(keys, aes_key, origin_sae, target_saes):
+def store_generated_keys(keys, aes_key, origin_sae, target_saes, encrypted_keys=None):
     """
-    Stores the generated keys after encryption in the database via KeyMaterial.
+    Stores the generated keys (packed bytes) after encryption in the database via KeyMaterial.
+    The AES key is stored once for the batch as its key-encryption key (KEK), and the rows and
+    their SAE relationships are bulk inserted, so the number of queries does not depend on the number of keys.
+    The keys may already be encrypted with the AES key (encrypted_keys), e.g. by a worker process.
     """
 
+    mode = settings.KEY_ENCRYPTION_MODE
+    if encrypted_keys is None:
+        with stage('encrypt'):
+            encrypted_keys = encrypt_keys_aes(keys, aes_key, mode)
+
+    kek = create_kek(aes_key, mode)
+    key_materials = []
     stored_keys = []
-    with transaction.atomic():  # Ensure transactional integrity.
-        for key in keys:
-            key_str = ''.join(map(str, key))
-            encrypted_data = encrypt_key_aes(key_str, aes_key)
-            aes_key_encoded = base64.b64encode(aes_key).decode('utf-8')
-
-            key_id = uuid.uuid4()
-            key_material = KeyMaterial.objects.create(
-                key_id=key_id,
-                encrypted_key=encrypted_data['ciphertext'],
-                aes_key=aes_key_encoded,
-                iv=encrypted_data['iv']
-            )
-            key_material.consult_by.set(target_saes)
-            key_material.save()
-
-            key_instance = Key.objects.create(
-                key_id=key_id,
-                key_data=base64.b64decode(encrypted_data['ciphertext']),  # Unencrypted version, if needed.
-                origin_sae=origin_sae,
-                size=len(key)  # Size in bits
-            )
-            key_instance.target_saes.set(target_saes)
-            key_instance.save()
-
-            # Adding key information to the list of stored keys for the response.
-            stored_keys.append({
-                "key_ID": str(key_id),
-                "encrypted_key": encrypted_data['ciphertext']
-            })
+    for key, encrypted_key in zip(keys, encrypted_keys):
+        key_id = uuid.uuid4()
+        key_materials.append(KeyMaterial(
+            key_id=key_id,
+            encrypted_key=encrypted_key,
+            kek=kek,
+            kme_id=origin_sae.kme_id,  # Keys are accounted in the KME of the master SAE.
+            origin_sae=origin_sae,
+            size=len(key) * 8  # Size in bits
+        ))
+
+        # Adding key information to the list of stored keys for the response.
+        stored_keys.append({
+            "key_ID": str(key_id),
+            "encrypted_key": base64.b64encode(encrypted_key).decode('utf-8')
+        })
+
+    with stage('store'), transaction.atomic():  # Ensure transactional integrity.
+        kek.save(force_insert=True)
+        KeyMaterial.objects.bulk_create(key_materials)
+        KeyDelivery.objects.bulk_create(
+            KeyDelivery(keymaterial_id=key_material.key_id, sae_id=sae.sae_id)
+            for key_material in key_materials for sae in target_saes
+        )
     return stored_keys
 
 
-def create_kme_connection(source_kme, target_kme, connection_certificate):
+def decrypt_key_materials(key_materials):
     """
-    Creates or updates the connection between two KMEs.
+    Decrypts KeyMaterial (or PooledKey) rows in batches of rows sharing the same KEK.
+    The KEKs are looked up once per batch, through the KEK cache.
+    Returns the decrypted keys (bytes) in the order of the rows.
+    """
+    batches = {}
+    for index, key_material in enumerate(key_materials):
+        batches.setdefault(key_material.kek_id, []).append(index)
+
+    keks = get_keks(list(batches))
+    decrypted_keys = [None] * len(key_materials)
+    for kek_id, indexes in batches.items():
+        aes_key, mode = keks[kek_id]
+        encrypted_keys = [bytes(key_materials[index].encrypted_key) for index in indexes]
+        for index, decrypted_key in zip(indexes, decrypt_keys_aes(encrypted_keys, aes_key, mode)):
+            decrypted_keys[index] = decrypted_key
+    return decrypted_keys
+
+
+def encode_key(key_material):
+    """Entry of a stored key in the enc_keys responses: its ID and its encrypted key in base64."""
+    return {"key_ID": str(key_material.key_id), "key": base64.b64encode(key_material.encrypted_key).decode('utf-8')}
+
+
+def encode_key_cursor(key_material):
+    """Encode the position of a KeyMaterial row as an opaque pagination cursor."""
+    position = f"{key_material.created_at.isoformat()}|{key_material.key_id}"
+    return base64.urlsafe_b64encode(position.encode()).decode('utf-8')
+
+
+def decode_key_cursor(cursor):
+    """
+    Decode a pagination cursor into its (created_at, key_id) position.
+    Raises ValueError if the cursor is malformed.
+    """
+    try:
+        created_at, key_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), uuid.UUID(key_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+
+def get_key_page(slave_sae, cursor=None, page_size=None):
+    """
+    Retrieves a page of the unconsumed keys shared with a slave SAE, ordered by (created_at, key_id).
+    Returns the keys of the page and the cursor of the next page (None on the last page).
+    """
+    if page_size is None:
+        page_size = settings.KEY_PAGE_SIZE
+    if page_size < 1:
+        raise ValueError("Invalid page size")
+    page_size = min(page_size, settings.KEY_PAGE_SIZE_MAX)
+    keys = (KeyMaterial.objects
+            .filter(deliveries__sae=slave_sae, deliveries__consumed_at__isnull=True)
+            .only('key_id', 'encrypted_key', 'created_at'))
+
+    if cursor:
+        created_at, key_id = decode_key_cursor(cursor)
+        keys = keys.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, key_id__gt=key_id))
+
+    # Fetch one extra row to know whether there is a next page.
+    keys = list(keys.order_by('created_at', 'key_id')[:page_size + 1])
+    next_cursor = encode_key_cursor(keys[page_size - 1]) if len(keys) > page_size else None
+    return keys[:page_size], next_cursor
+
+
+def has_unconsumed_keys(slave_sae):
+    """Whether the queue of a slave SAE holds unconsumed keys."""
+    return KeyDelivery.objects.filter(sae=slave_sae, consumed_at__isnull=True).exists()
+
+
+def stream_keys(slave_sae):
+    """
+    Streams all the unconsumed keys shared with a slave SAE as a JSON document, without loading them in memory.
+    """
+    keys = (KeyMaterial.objects
+            .filter(deliveries__sae=slave_sae, deliveries__consumed_at__isnull=True)
+            .only('key_id', 'encrypted_key', 'created_at')
+            .order_by('created_at', 'key_id'))
+
+    yield '{"keys": ['
+    separator = ''
+    for key in keys.iterator(chunk_size=settings.KEY_PAGE_SIZE):
+        yield separator + json.dumps(encode_key(key))
+        separator = ', '
+    yield ']}'
+
+
+def claim_keys(slave_sae, number):
     """
-    connection, created = KMEConnection.objects.get_or_create(
-        source_kme=source_kme,
-        target_kme=target_kme,
-        defaults={'connection_certificate': connection_certificate}
+    Atomically takes the next `number` unconsumed keys of the queue of a slave SAE and marks them consumed.
+    Concurrent claims skip the rows locked by each other where the database supports it.
+    The claimed keys stay stored until they are retrieved in plaintext with dec_keys.
+    """
+    with transaction.atomic():
+        deliveries = (KeyDelivery.objects
+                      .filter(sae=slave_sae, consumed_at__isnull=True)
+                      .select_related('keymaterial')
+                      .order_by('created_at', 'id'))
+        if connection.features.has_select_for_update_skip_locked:
+            deliveries = deliveries.select_for_update(skip_locked=True, of=('self',))
+        deliveries = list(deliveries[:number])
+
+        KeyDelivery.objects.filter(id__in=[delivery.id for delivery in deliveries]).update(
+            consumed_at=timezone.now()
+        )
+    return [delivery.keymaterial for delivery in deliveries]
+
+
+def consume_keys(sae, key_ids):
+    """
+    Records the retrieval of keys in plaintext with dec_keys: their decryption time, which allows
+    their purge, and the consumption of the queue entries of the SAE for them.
+    """
+    now = timezone.now()
+    KeyMaterial.objects.filter(key_id__in=key_ids, decrypted_at__isnull=True).update(decrypted_at=now)
+    KeyDelivery.objects.filter(sae=sae, keymaterial_id__in=key_ids, consumed_at__isnull=True).update(
+        consumed_at=now
     )
-    if not created:
-        connection.connection_certificate = connection_certificate
-        connection.save()
+
+
+def purge_consumed_keys():
+    """
+    Deletes the keys retrieved in plaintext (dec_keys) and consumed by every SAE they were shared with,
+    and releases their storage in the stored_key_count of the KMEs. Returns the number of purged keys.
+    """
+    with transaction.atomic():
+        key_ids = list(KeyMaterial.objects
+                       .filter(deliveries__isnull=False, decrypted_at__isnull=False)
+                       .exclude(deliveries__consumed_at__isnull=True)
+                       .values_list('key_id', flat=True)
+                       .distinct())
+        if not key_ids:
+            return 0
+
+        purged_by_kme = (KeyMaterial.objects.filter(key_id__in=key_ids)
+                         .values('kme')
+                         .annotate(count=Count('key_id')))
+        for purged in purged_by_kme:
+            release_key_capacity(KME(kme_id=purged['kme']), purged['count'])
+
+        KeyMaterial.objects.filter(key_id__in=key_ids).delete()
+        # KEKs of fully purged batches (and of fully taken key pool batches).
+        KeyEncryptionKey.objects.filter(keys__isnull=True, pooled_keys__isnull=True).delete()
+    return len(key_ids)
+
+
+def delete_stored_keys(key_ids):
+    """
+    Deletes stored keys with their queue entries, and the KEKs left without keys, e.g. the keys
+    of a request that failed after they were stored. Their storage is released by the caller.
+    """
+    with transaction.atomic():
+        kek_ids = set(KeyMaterial.objects.filter(key_id__in=key_ids).values_list('kek_id', flat=True))
+        KeyMaterial.objects.filter(key_id__in=key_ids).delete()
+        KeyEncryptionKey.objects.filter(kek_id__in=kek_ids, keys__isnull=True, pooled_keys__isnull=True).delete()
+
+
+def create_kme_connection(source_kme, target_kme, connection_certificate, relay_secret=None):
+    """
+    Creates or updates the connection between two KMEs.
+    The relay secret, which signs the keys relayed from the source to the target, must be
+    configured with the same value on both KMEs; it is kept unchanged if not given.
+    """
+    defaults = {'connection_certificate': connection_certificate}
+    if relay_secret is not None:
+        defaults['relay_secret'] = relay_secret
+    KMEConnection.objects.update_or_create(source_kme=source_kme, target_kme=target_kme, defaults=defaults)
 
 
 def create_connection_between_kmes(request):
@@ -70,6 +239,7 @@ def create_connection_between_kmes(request):
     source_kme_id = request.data.get('source_kme_id')
     target_kme_id = request.data.get('target_kme_id')
     certificate = request.data.get('certificate')
+    relay_secret = request.data.get('relay_secret')  # In base64.
 
     # Retrieve the KMEs.
     try:
@@ -78,20 +248,38 @@ def create_connection_between_kmes(request):
     except KME.DoesNotExist:
         return Response({"error": "KME not found"}, status=status.HTTP_404_NOT_FOUND)
 
+    try:
+        relay_secret = base64.b64decode(relay_secret, validate=True) if relay_secret else None
+    except binascii.Error:
+        return Response({"error": "Invalid relay secret"}, status=status.HTTP_400_BAD_REQUEST)
+
     # Create or update the connection.
-    create_kme_connection(source_kme, target_kme, certificate)
+    create_kme_connection(source_kme, target_kme, certificate, relay_secret)
 
     return Response({"message": "Connection created or updated successfully."}, status=status.HTTP_200_OK)
 
 
-def update_kme_key_count(kme, new_keys_count):
+def reserve_key_capacity(kme, new_keys_count):
     """
-    Updates the number of stored keys in a KME after key generation or exchange.
+    Reserves the storage of new keys in a KME before key generation or exchange.
+    The count is checked and updated by a single conditional UPDATE, so concurrent
+    requests cannot exceed the capacity or lose updates.
     """
-    kme.stored_key_count += new_keys_count
-    if kme.stored_key_count > kme.max_key_count:
+    reserved = KME.objects.filter(
+        kme_id=kme.kme_id,
+        stored_key_count__lte=F('max_key_count') - new_keys_count
+    ).update(stored_key_count=F('stored_key_count') + new_keys_count)
+    if not reserved:
         raise ValueError("The maximum key storage capacity of the KME has been reached.")
-    kme.save()
+
+
+def release_key_capacity(kme, keys_count):
+    """
+    Releases the storage of keys in a KME, e.g. when a reserved generation fails.
+    """
+    KME.objects.filter(kme_id=kme.kme_id).update(
+        stored_key_count=Greatest(F('stored_key_count') - keys_count, 0)
+    )
 
 
 def get_additional_slave(request, add_slave_id):
@@ -104,7 +292,7 @@ def get_additional_slave(request, add_slave_id):
     if not add_slave_sae_ids:
         return []
     # Retrieve the SAE instances corresponding to the provided IDs.
-    slave_saes = SAE.objects.filter(sae_id__in=add_slave_sae_ids)
+    slave_saes = SAE.objects.filter(sae_id__in=add_slave_sae_ids).select_related('kme')
 
     # Check if any SAEs were not found.
     if not slave_saes.exists():
@@ -147,15 +335,34 @@ def validate_certificates(kme_master, kme_slave):
         return False
 
 
-def send_keys_to_kme2(kme_slave, sae_slave, stored_keys, aes_key):
-
-    data = {
-        "sae_slave_id": str(sae_slave.sae_id),
-        "keys": stored_keys,
-        "aes_key": base64.b64encode(aes_key).decode('utf-8')
-    }
-    response = requests.post(f"{kme_slave.hostname}/api/v1/keys/enc_keys/", json=data)
-    return response
-
-
-
+def ingest_relayed_keys(sae_slave, payload):
+    """
+    Stores the keys relayed by a peer KME for a local slave SAE, in bulk.
+    Keys already received (e.g. on a retried relay) are skipped, and their storage is
+    reserved in the KME of the slave SAE. Returns the number of new keys.
+    Raises ValueError if the keys cannot be decrypted with the relayed AES key.
+    """
+    aes_key = base64.b64decode(payload['aes_key'])
+    mode = payload.get('mode', 'CBC')
+
+    relayed_keys = {uuid.UUID(key['key_ID']): base64.b64decode(key['encrypted_key']) for key in payload['keys']}
+    existing = set(KeyMaterial.objects.filter(key_id__in=relayed_keys).values_list('key_id', flat=True))
+    new_keys = {key_id: ciphertext for key_id, ciphertext in relayed_keys.items() if key_id not in existing}
+    if not new_keys:
+        return 0
+
+    # The sizes of the keys are not relayed: decrypting them also checks the relayed AES key.
+    sizes = [len(key) * 8 for key in decrypt_keys_aes(list(new_keys.values()), aes_key, mode)]
+
+    kek = create_kek(aes_key, mode)
+    with transaction.atomic():
+        reserve_key_capacity(sae_slave.kme, len(new_keys))
+        kek.save(force_insert=True)
+        KeyMaterial.objects.bulk_create(
+            KeyMaterial(key_id=key_id, encrypted_key=ciphertext, kek=kek, kme_id=sae_slave.kme_id, size=size)
+            for (key_id, ciphertext), size in zip(new_keys.items(), sizes)
+        )
+        KeyDelivery.objects.bulk_create(
+            KeyDelivery(keymaterial_id=key_id, sae_id=sae_slave.sae_id) for key_id in new_keys
+        )
+    return len(new_keys)
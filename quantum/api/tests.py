@@ -1,3 +1,868 @@
-from django.test import TestCase
+import asyncio
+import base64
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import requests
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+from Crypto.Util.Padding import pad
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import bb84, keygen
+from .bb84 import generate_sifted_bits, generate_sifted_pairs, get_noise_model
+from .checks import check_kek_master_key
+from .encryptor import decrypt_key_aes, decrypt_keys_aes, encrypt_key_aes, encrypt_keys_aes
+from .jobs import resume_key_jobs, run_pending_key_jobs
+from .kek import clear_kek_cache, get_master_key
+from .keygen import KeyGenerationBusy, generate_encrypted_keys, run_key_generation
+from .metrics import clear_metrics, render_metrics
+from .models import KME, SAE, KMEConnection, KeyDelivery, KeyEncryptionKey, KeyGenerationJob, KeyMaterial, PooledKey
+from .pool import refill_key_pool, take_pooled_keys
+from .postprocessing import QBERTooHigh, amplify_privacy, binary_entropy, toeplitz_hash
+from .reservoir import clear_reservoirs, get_reservoir, take_exact_keys
+from .relay import RELAY_PATH, KeyRelayBatch, close_peer_sessions, post_to_peer, relay_headers, verify_relay
+from .service import (claim_keys, consume_keys, get_key_page, purge_consumed_keys, release_key_capacity,
+                      reserve_key_capacity, store_generated_keys)
+
+
+RELAY_SECRET = b'relay secret shared by the KMEs'
+
+
+def authenticated_client():
+    client = APIClient()
+    client.force_authenticate(User.objects.create_user('sae'))
+    return client
+
+
+def create_topology(**kme_fields):
+    """A KME with a master SAE and a slave SAE."""
+    kme = KME.objects.create(name='kme', hostname='localhost', **kme_fields)
+    master = SAE.objects.create(name='master', kme=kme, is_master=True)
+    slave = SAE.objects.create(name='slave', kme=kme)
+    return kme, master, slave
+
+
+@override_settings(BB84_ENGINE='analytic', KEY_POOL_MAX_BITS=64 * 32, KEY_ENCRYPTION_MODE='CBC')
+class KeyPoolTests(TestCase):
+
+    def setUp(self):
+        self.kme, self.master, self.slave = create_topology(key_size=64, max_key_per_request=8)
+
+    def test_pooled_keys_are_encrypted(self):
+        added = refill_key_pool(self.kme)
+        self.assertGreater(added, 0)
+        self.assertEqual(KeyEncryptionKey.objects.filter(pooled_keys__isnull=False).distinct().count(),
+                         -(-added // 8))
+
+        pooled = list(PooledKey.objects.order_by('id')[:3])
+        keys = take_pooled_keys(self.kme, 3, 64)
+        self.assertEqual([len(key) for key in keys], [8, 8, 8])
+        for pooled_key, key in zip(pooled, keys):
+            self.assertNotIn(key, bytes(pooled_key.encrypted_key))
+            self.assertEqual(len(pooled_key.encrypted_key), 16 + 16)  # IV and one padded block.
+
+    def test_pool_miss(self):
+        refill_key_pool(self.kme)
+        self.assertIsNone(take_pooled_keys(self.kme, 3, 128))
+
+    @override_settings(KEY_POOL_KEY_SIZES=[64, 128])
+    def test_pool_key_sizes(self):
+        refill_key_pool(self.kme)
+        self.assertEqual([len(key) for key in take_pooled_keys(self.kme, 3, 64)], [8, 8, 8])
+        self.assertEqual([len(key) for key in take_pooled_keys(self.kme, 3, 128)], [16, 16, 16])
+        # The pool budget is shared equally between the sizes.
+        self.assertLessEqual(PooledKey.objects.filter(size=128).count(), 64 * 32 // 2 // 128)
+
+    def test_purge_keeps_the_keks_of_pooled_keys(self):
+        refill_key_pool(self.kme)
+        pool_keks = set(KeyEncryptionKey.objects.values_list('kek_id', flat=True))
+        stored = store_generated_keys([b'\x00' * 8], b'k' * 16, self.master, [self.slave])
+        claim_keys(self.slave, 1)
+        consume_keys(self.master, [stored[0]['key_ID']])
+
+        self.assertEqual(purge_consumed_keys(), 1)
+        self.assertEqual(set(KeyEncryptionKey.objects.values_list('kek_id', flat=True)), pool_keks)
+
+
+class DecKeysTests(TestCase):
+
+    def setUp(self):
+        self.kme, self.master, self.slave = create_topology()
+        self.client = authenticated_client()
+        self.stored = store_generated_keys([b'\xb6', b'\x01\x02'], b'k' * 16, self.master, [self.slave])
+
+    def get_keys(self, **params):
+        response = self.client.get(f'/api/v1/keys/{self.master.sae_id}/dec_keys/',
+                                   {'key_ID': [key['key_ID'] for key in self.stored], **params})
+        self.assertEqual(response.status_code, 200)
+        return {key['key_ID']: key for key in response.json()['keys']}
+
+    def test_base64_format(self):
+        keys = self.get_keys()
+        self.assertEqual([base64.b64decode(keys[key['key_ID']]['key']) for key in self.stored],
+                         [b'\xb6', b'\x01\x02'])
+
+    def test_bits_format(self):
+        keys = self.get_keys(key_format='bits')
+        self.assertEqual(keys[self.stored[0]['key_ID']]['decrpyted_key'], [1, 0, 1, 1, 0, 1, 1, 0])
+        self.assertEqual(len(keys[self.stored[1]['key_ID']]['decrpyted_key']), 16)
+
+    def test_claimed_keys_are_kept_until_decrypted(self):
+        # Claiming returns the keys encrypted under a KEK of the KME: they are purged once decrypted.
+        response = self.client.get(f'/api/v1/keys/{self.slave.sae_id}/enc_keys/', {'number': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(purge_consumed_keys(), 0)
+
+        self.get_keys()
+        self.assertEqual(purge_consumed_keys(), 2)
+        response = self.client.get(f'/api/v1/keys/{self.master.sae_id}/dec_keys/',
+                                   {'key_ID': [key['key_ID'] for key in self.stored]})
+        self.assertEqual(response.status_code, 404)
+
+    def test_changed_master_key(self):
+        # The keys were wrapped under another master key: a server error, not a crash.
+        clear_kek_cache()
+        with override_settings(KEK_MASTER_KEY=base64.b64encode(b'm' * 32).decode()):
+            response = self.client.get(f'/api/v1/keys/{self.master.sae_id}/dec_keys/',
+                                       {'key_ID': [key['key_ID'] for key in self.stored]})
+        self.assertEqual(response.status_code, 500)
+        self.assertIn('KEK_MASTER_KEY', response.json()['error'])
+
+
+class MasterKeyTests(SimpleTestCase):
+
+    @override_settings(KEK_MASTER_KEY='')
+    def test_required(self):
+        with self.assertRaises(ImproperlyConfigured):
+            get_master_key()
+        self.assertEqual([error.id for error in check_kek_master_key(None)], ['api.E001'])
+
+    @override_settings(KEK_MASTER_KEY=base64.b64encode(b'm' * 20).decode())
+    def test_invalid_size(self):
+        self.assertEqual([error.id for error in check_kek_master_key(None)], ['api.E002'])
+
+    def test_configured(self):
+        self.assertEqual(check_kek_master_key(None), [])
+        self.assertEqual(len(get_master_key()), 32)
+
+
+class BatchEncryptionTests(SimpleTestCase):
+    aes_key = bytes(range(16))
+
+    def check_round_trip(self, keys):
+        encrypted_keys = encrypt_keys_aes(keys, self.aes_key, 'CBC')
+        for key, encrypted_key in zip(keys, encrypted_keys):
+            # Each key is a standard CBC encryption: IV + ciphertext of the padded key.
+            iv = encrypted_key[:AES.block_size]
+            expected = AES.new(self.aes_key, AES.MODE_CBC, iv).encrypt(pad(key, AES.block_size))
+            self.assertEqual(encrypted_key[AES.block_size:], expected)
+            self.assertEqual(decrypt_key_aes(base64.b64encode(encrypted_key), self.aes_key), key)
+        self.assertEqual(decrypt_keys_aes(encrypted_keys, self.aes_key, 'CBC'), keys)
+
+        # The batch decryption also reads the keys of encrypt_key_aes.
+        single = [base64.b64decode(encrypt_key_aes(key, self.aes_key)['ciphertext']) for key in keys]
+        self.assertEqual(decrypt_keys_aes(single, self.aes_key, 'CBC'), keys)
+
+    def test_empty_key(self):
+        self.check_round_trip([b''])
+
+    def test_block_boundaries(self):
+        for length in (15, 16, 17):
+            with self.subTest(length=length):
+                self.check_round_trip([get_random_bytes(length)])
+
+    def test_mixed_lengths(self):
+        self.check_round_trip([get_random_bytes(length) for length in (0, 1, 15, 16, 17, 32, 33, 100, 8)])
+
+    def test_empty_batch(self):
+        self.assertEqual(encrypt_keys_aes([], self.aes_key, 'CBC'), [])
+        self.assertEqual(decrypt_keys_aes([], self.aes_key, 'CBC'), [])
+
+    def test_gcm(self):
+        keys = [get_random_bytes(length) for length in (0, 15, 16, 17)]
+        encrypted_keys = encrypt_keys_aes(keys, self.aes_key, 'GCM')
+        self.assertEqual(decrypt_keys_aes(encrypted_keys, self.aes_key, 'GCM'), keys)
+
+        tampered = encrypted_keys[1][:-1] + bytes([encrypted_keys[1][-1] ^ 1])
+        with self.assertRaises(ValueError):
+            decrypt_keys_aes([tampered], self.aes_key, 'GCM')
+
+
+class KeyQueueTests(TestCase):
+
+    def setUp(self):
+        self.kme, self.master, self.slave = create_topology(max_key_count=10)
+        self.other_slave = SAE.objects.create(name='other slave', kme=self.kme)
+
+    def store(self, number, target_saes):
+        reserve_key_capacity(self.kme, number)
+        keys = [bytes([index]) * 8 for index in range(number)]
+        return [key['key_ID'] for key in store_generated_keys(keys, b'k' * 16, self.master, target_saes)]
+
+    def stored_key_count(self):
+        return KME.objects.get(kme_id=self.kme.kme_id).stored_key_count
+
+    def test_claim_in_order_once(self):
+        key_ids = self.store(3, [self.slave])
+        self.assertEqual([str(key.key_id) for key in claim_keys(self.slave, 2)], key_ids[:2])
+        self.assertEqual([str(key.key_id) for key in claim_keys(self.slave, 2)], key_ids[2:])
+        self.assertEqual(claim_keys(self.slave, 2), [])
+
+    def test_purge_waits_for_every_sae(self):
+        key_ids = self.store(2, [self.slave, self.other_slave])
+        consume_keys(self.master, key_ids)  # Retrieved with dec_keys.
+        claim_keys(self.slave, 2)
+        self.assertEqual(purge_consumed_keys(), 0)
+
+        claim_keys(self.other_slave, 1)
+        self.assertEqual(purge_consumed_keys(), 1)
+        self.assertEqual(KeyMaterial.objects.count(), 1)
+        self.assertEqual(self.stored_key_count(), 1)
+
+        claim_keys(self.other_slave, 1)
+        self.assertEqual(purge_consumed_keys(), 1)
+        self.assertEqual(self.stored_key_count(), 0)
+        self.assertFalse(KeyEncryptionKey.objects.exists())
+
+    def test_capacity_reservation(self):
+        reserve_key_capacity(self.kme, 8)
+        with self.assertRaises(ValueError):
+            reserve_key_capacity(self.kme, 3)
+        self.assertEqual(self.stored_key_count(), 8)
+
+        reserve_key_capacity(self.kme, 2)
+        self.assertEqual(self.stored_key_count(), 10)
+        release_key_capacity(self.kme, 12)
+        self.assertEqual(self.stored_key_count(), 0)
+
+    @override_settings(KEY_PAGE_SIZE=2, KEY_PAGE_SIZE_MAX=3)
+    def test_cursor_pagination(self):
+        key_ids = self.store(5, [self.slave])
+        # Keys created in the same instant are ordered by key ID.
+        expected = [str(key.key_id) for key in KeyMaterial.objects.order_by('created_at', 'key_id')]
+        self.assertEqual(sorted(expected), sorted(key_ids))
+
+        pages = []
+        cursor = None
+        while True:
+            keys, cursor = get_key_page(self.slave, cursor)
+            pages.append([str(key.key_id) for key in keys])
+            if cursor is None:
+                break
+        self.assertEqual(pages, [expected[:2], expected[2:4], expected[4:]])
+
+        keys, cursor = get_key_page(self.slave, page_size=10)  # Capped at KEY_PAGE_SIZE_MAX.
+        self.assertEqual(len(keys), 3)
+        with self.assertRaises(ValueError):
+            get_key_page(self.slave, 'not a cursor')
+
+    def test_pagination_skips_consumed_keys(self):
+        self.store(3, [self.slave])
+        claimed = claim_keys(self.slave, 1)
+        keys, _ = get_key_page(self.slave)
+        self.assertNotIn(claimed[0].key_id, [key.key_id for key in keys])
+        self.assertEqual(len(keys), 2)
+
+
+class ToeplitzHashTests(SimpleTestCase):
+
+    def test_matches_matrix_product(self):
+        rng = np.random.default_rng(0)
+        for n, output_bits in ((1, 1), (7, 3), (64, 64), (200, 57)):
+            with self.subTest(n=n, output_bits=output_bits):
+                bits = rng.integers(0, 2, size=(3, n), dtype=np.uint8)
+                seeds = rng.integers(0, 2, size=(3, n + output_bits - 1), dtype=np.uint8)
+                hashed = toeplitz_hash(bits, output_bits, seeds)
+                for block, seed, result in zip(bits, seeds, hashed):
+                    rows, columns = np.indices((output_bits, n))
+                    matrix = seed[rows - columns + n - 1].astype(np.int64)
+                    np.testing.assert_array_equal(result, (matrix @ block) % 2)
+
+
+class PrivacyAmplificationTests(SimpleTestCase):
+
+    def test_binary_entropy(self):
+        np.testing.assert_array_equal(binary_entropy([0, 0.5, 1]), [0, 1, 0])
+
+    def test_noiseless_blocks(self):
+        # No error: every undisclosed bit but the security margin is kept.
+        rng = np.random.default_rng(0)
+        bits = rng.integers(0, 2, size=(2, 2048), dtype=np.uint8)
+        amplified, qber = amplify_privacy(bits, bits, 204, 0.11, 64, rng)
+        np.testing.assert_array_equal(qber, [0, 0])
+        self.assertEqual(amplified.size, 2 * (2048 - 204 - 64))
+
+    def test_qber_too_high(self):
+        rng = np.random.default_rng(0)
+        bits = rng.integers(0, 2, size=(1, 1024), dtype=np.uint8)
+        with self.assertRaises(QBERTooHigh):
+            amplify_privacy(bits, 1 - bits, 102, 0.11, 64, rng)
+        self.assertFalse(issubclass(QBERTooHigh, ValueError))
+
+
+@override_settings(BB84_CHUNK_QUBITS=16)
+class ChannelNoiseTests(SimpleTestCase):
+
+    def test_noiseless_by_default(self):
+        self.assertIsNone(get_noise_model())
+        alice_bits, bob_bits = generate_sifted_pairs(64, 'qiskit_chunked')
+        np.testing.assert_array_equal(alice_bits, bob_bits)
+
+    @override_settings(BB84_NOISE_DEPOLARIZING=0.2, BB84_NOISE_READOUT=0.05)
+    def test_noisy_channel(self):
+        alice_bits, bob_bits = generate_sifted_pairs(400, 'qiskit_chunked')
+        qber = (alice_bits != bob_bits).mean()
+        # Expected QBER: 0.2 / 2 + 0.05 - 2 * 0.1 * 0.05 = 0.14.
+        self.assertGreater(qber, 0.05)
+        self.assertLess(qber, 0.3)
+
+    def test_every_engine_reads_bob_bits(self):
+        # Bob reads every bit flipped: the sifted keys are the complements of the noiseless ones.
+        for engine in ('qiskit', 'qiskit_batched', 'qiskit_chunked'):
+            with self.subTest(engine=engine):
+                np.random.seed(0)
+                keys = bb84.generate_bb84_keys(2, 16, engine)
+                np.random.seed(0)
+                with override_settings(BB84_NOISE_READOUT=1.0):
+                    flipped = bb84.generate_bb84_keys(2, 16, engine)
+                self.assertEqual(flipped, [bytes(~byte & 0xff for byte in key) for key in keys])
+
+
+@override_settings(BB84_CHUNK_QUBITS=16, BB84_POSTPROCESSING=False)
+class SiftedBitReservoirTests(SimpleTestCase):
+
+    def setUp(self):
+        clear_reservoirs()
+        self.addCleanup(clear_reservoirs)
+
+    def test_independent_bases(self):
+        # Alice and Bob draw their bases independently: the raw qubits measured in the other
+        # basis are simulated, then discarded by the sifting.
+        with mock.patch('api.bb84.simulate_bob_bits', wraps=bb84.simulate_bob_bits) as simulate:
+            alice_bits, bob_bits = generate_sifted_pairs(40, 'qiskit_chunked')
+        raw_qubits = sum(call.args[0].size for call in simulate.call_args_list)
+        mismatched = sum(int((call.args[1] != call.args[2]).sum()) for call in simulate.call_args_list)
+        self.assertGreaterEqual(alice_bits.size, 40)
+        self.assertEqual(raw_qubits % 16, 0)
+        self.assertEqual(raw_qubits - mismatched, alice_bits.size)
+        self.assertGreater(mismatched, 0)
+        np.testing.assert_array_equal(alice_bits, bob_bits)
+
+    def test_surplus_is_kept(self):
+        generated = []
+
+        def record(num_bits, engine=None):
+            generated.append(generate_sifted_bits(num_bits, engine))
+            return generated[-1]
+
+        with mock.patch('api.reservoir.generate_sifted_bits', side_effect=record):
+            keys = take_exact_keys('link', 3, 16, 'analytic')
+            leftover = get_reservoir('link').bits.size
+            self.assertEqual(leftover, sum(bits.size for bits in generated) - 48)
+            # The next request is served from the surplus first.
+            take_exact_keys('link', 1, 16, 'analytic')
+
+        self.assertEqual([len(key) for key in keys], [2, 2, 2])
+        self.assertEqual(np.packbits(np.concatenate(generated))[:6].tobytes(), b''.join(keys))
+        self.assertEqual(len(generated), 1 if leftover >= 16 else 2)
+
+
+@override_settings(KEY_PAGE_SIZE_MAX=5)
+class EncKeysGetTests(TestCase):
+
+    def setUp(self):
+        self.kme, self.master, self.slave = create_topology()
+        self.client = authenticated_client()
+        store_generated_keys([b'\x00' * 8] * 3, b'k' * 16, self.master, [self.slave])
+
+    def get_keys(self, **params):
+        return self.client.get(f'/api/v1/keys/{self.slave.sae_id}/enc_keys/', params)
+
+    def test_claim_number(self):
+        response = self.get_keys(number=2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['keys']), 2)
+
+    def test_invalid_number(self):
+        for number in ('-1', '0', '6', 'two'):
+            with self.subTest(number=number):
+                self.assertEqual(self.get_keys(number=number).status_code, 400)
+        self.assertFalse(KeyDelivery.objects.filter(consumed_at__isnull=False).exists())
+
+    def test_invalid_page_size(self):
+        for page_size in ('-1', '0', 'ten'):
+            with self.subTest(page_size=page_size):
+                self.assertEqual(self.get_keys(page_size=page_size).status_code, 400)
+
+    def test_stream(self):
+        response = self.get_keys(stream='true')
+        self.assertEqual(response.status_code, 200)
+        keys = json.loads(b''.join(response.streaming_content))['keys']
+        self.assertEqual(len(keys), 3)
+        self.assertEqual({base64.b64decode(key['key']) for key in keys},
+                         {bytes(key.encrypted_key) for key in KeyMaterial.objects.all()})
+
+    def test_no_keys(self):
+        self.get_keys(number=3)
+        # The paged and the streaming paths both answer 404 once the queue is empty.
+        self.assertEqual(self.get_keys().status_code, 404)
+        self.assertEqual(self.get_keys(stream='true').status_code, 404)
+
+
+@override_settings(BB84_ENGINE='analytic', KEY_POOL_ENABLED=False)
+class EncKeysPostTests(TestCase):
+
+    def setUp(self):
+        self.kme, self.master, self.slave = create_topology(max_key_count=4)
+        self.client = authenticated_client()
+
+    def post_keys(self, **data):
+        return self.client.post(f'/api/v1/keys/{self.slave.sae_id}/enc_keys/',
+                                {'master_sae_id': str(self.master.sae_id), **data}, format='json')
+
+    def partners(self):
+        return dict(SAE.objects.values_list('name', 'communicates_with__name'))
+
+    def test_default_size(self):
+        response = self.post_keys(number=1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(KeyMaterial.objects.get().size, self.kme.key_size)
+
+    def test_generate(self):
+        response = self.post_keys(number=2, size=64)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['keys']), 2)
+        self.assertEqual(self.partners(), {'master': 'slave', 'slave': 'master'})
+        self.assertEqual(KME.objects.get(kme_id=self.kme.kme_id).stored_key_count, 2)
+
+    def test_rejected_requests_write_nothing(self):
+        for data, status_code in (({'number': 2, 'size': 12}, 400),
+                                  ({'number': 5, 'size': 64}, 400),
+                                  ({'number': 1, 'size': 0}, 400),
+                                  ({'number': 1, 'size': 56}, 400),  # Below min_key_size.
+                                  ({'number': 1, 'size': 1032}, 400),  # Above max_key_size.
+                                  ({'number': 129, 'size': 64}, 400),  # Above max_key_per_request.
+                                  ({'number': 1, 'size': 64, 'add_slave_id': [str(uuid.uuid4())]}, 404)):
+            with self.subTest(data=data):
+                self.assertEqual(self.post_keys(**data).status_code, status_code)
+                self.assertEqual(self.partners(), {'master': None, 'slave': None})
+                self.assertEqual(KME.objects.get(kme_id=self.kme.kme_id).stored_key_count, 0)
+
+    def test_pairing_changed_by_another_process(self):
+        other = SAE.objects.create(name='other', kme=self.kme)
+        # The second request caches the SAEs paired by the first one.
+        for _ in range(2):
+            self.assertEqual(self.post_keys(number=1, size=64).status_code, 200)
+        # Another process pairs the SAEs with another SAE, without invalidating the cache of this one.
+        SAE.objects.filter(sae_id__in=[self.master.sae_id, self.slave.sae_id]).update(communicates_with=other)
+
+        self.assertEqual(self.post_keys(number=1, size=64).status_code, 200)
+        self.assertEqual(self.partners(), {'master': 'slave', 'slave': 'master', 'other': None})
+
+    @override_settings(BB84_ENGINE='analytic', BB84_EXACT_KEYS=True, BB84_POSTPROCESSING=True)
+    def test_channel_too_noisy(self):
+        # Bob reads every bit flipped: the generation is aborted, a failure of the service.
+        def eavesdropped(num_bits, engine=None):
+            alice_bits = np.random.randint(2, size=num_bits, dtype=np.uint8)
+            return alice_bits, 1 - alice_bits
+
+        clear_reservoirs()
+        self.addCleanup(clear_reservoirs)
+        with mock.patch('api.reservoir.generate_sifted_pairs', side_effect=eavesdropped):
+            response = self.post_keys(number=2, size=64)
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('QBER', response.json()['error'])
+        self.assertEqual(KME.objects.get(kme_id=self.kme.kme_id).stored_key_count, 0)
+
+
+@override_settings(METRICS_ENABLED=True, METRICS_TOKEN='scraper token', SLOW_REQUEST_THRESHOLD=0,
+                   BB84_ENGINE='analytic', KEY_POOL_ENABLED=False)
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        self.kme, self.master, self.slave = create_topology()
+        self.client = authenticated_client()
+        clear_metrics()
+        self.addCleanup(clear_metrics)
+
+    def post_keys(self):
+        response = self.client.post(f'/api/v1/keys/{self.slave.sae_id}/enc_keys/',
+                                    {'master_sae_id': str(self.master.sae_id), 'number': 2, 'size': 64},
+                                    format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def get_metrics(self, token='scraper token'):
+        return self.client.get('/api/v1/metrics/', HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def test_request_and_stage_metrics(self):
+        self.post_keys()
+        response = self.get_metrics()
+        self.assertEqual(response.status_code, 200)
+        lines = response.content.decode().splitlines()
+        self.assertIn('kme_stage_seconds_count{stage="store"} 1', lines)
+        self.assertIn('kme_request_seconds_count{view="keys-get-key",method="POST",status="200"} 1', lines)
+        self.assertIn('kme_request_queries_count{view="keys-get-key",method="POST"} 1', lines)
+        # The only request recorded made more than one query: the buckets of 1 and 2 queries are empty.
+        self.assertIn('kme_request_queries_bucket{view="keys-get-key",method="POST",le="2"} 0', lines)
+        self.assertIn('kme_request_queries_bucket{view="keys-get-key",method="POST",le="+Inf"} 1', lines)
+
+    def test_authentication(self):
+        self.assertEqual(self.client.get('/api/v1/metrics/').status_code, 401)
+        self.assertEqual(self.get_metrics('guess').status_code, 401)
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_disabled(self):
+        self.post_keys()
+        self.assertEqual(self.get_metrics().status_code, 404)
+        self.assertEqual(render_metrics().strip().splitlines()[-1],
+                         '# TYPE kme_request_db_seconds histogram')  # Nothing recorded.
+
+    @override_settings(SLOW_REQUEST_THRESHOLD=1e-9)
+    def test_slow_request_log(self):
+        with self.assertLogs('api.metrics', 'WARNING') as logs:
+            self.post_keys()
+        self.assertRegex(logs.output[0], r'Slow request POST .* \(keys-get-key\): .*store=.* queries=\d+ db=')
+
+
+@override_settings(KEY_JOBS_IN_PROCESS=False, KEY_JOB_CHUNK_SIZE=2, BB84_ENGINE='analytic')
+class KeyJobTests(TestCase):
+
+    def setUp(self):
+        self.kme, self.master, self.slave = create_topology(max_key_count=10)
+        self.client = authenticated_client()
+        # The generation runs in a thread instead of the process pool.
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        patcher = mock.patch('api.jobs.get_executor', return_value=executor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def submit(self, number):
+        response = self.client.post(f'/api/v1/keys/{self.slave.sae_id}/enc_keys/',
+                                    {'master_sae_id': str(self.master.sae_id), 'number': number, 'size': 64,
+                                     'async': True}, format='json')
+        self.assertEqual(response.status_code, 202)
+        return response.json()['job_ID']
+
+    def poll(self, job_id):
+        response = self.client.get(f'/api/v1/jobs/{job_id}/')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def stored_key_count(self):
+        return KME.objects.get(kme_id=self.kme.kme_id).stored_key_count
+
+    def test_submit_run_poll(self):
+        job_id = self.submit(3)
+        self.assertEqual(self.poll(job_id)['status'], KeyGenerationJob.PENDING)
+
+        self.assertEqual(run_pending_key_jobs(), 1)
+        job = self.poll(job_id)
+        self.assertEqual((job['status'], job['progress']), (KeyGenerationJob.DONE, 1))
+        self.assertEqual({key['key_ID'] for key in job['keys']},
+                         {str(key_id) for key_id in KeyMaterial.objects.values_list('key_id', flat=True)})
+        self.assertEqual(len(job['keys']), 3)
+        self.assertEqual(self.client.get(f'/api/v1/jobs/{uuid.uuid4()}/').status_code, 404)
+
+    def test_failing_chunk_releases_the_capacity(self):
+        job_id = self.submit(5)
+        self.assertEqual(self.stored_key_count(), 5)
+
+        chunks = []
+
+        def first_chunk_only(*args):
+            chunks.append(args)
+            if len(chunks) > 1:
+                raise RuntimeError("simulator crashed")
+            return generate_encrypted_keys(*args)
+
+        with mock.patch('api.jobs.generate_encrypted_keys', side_effect=first_chunk_only):
+            self.assertEqual(run_pending_key_jobs(), 1)
+
+        job = self.poll(job_id)
+        self.assertEqual((job['status'], job['error'], len(job['keys'])),
+                         (KeyGenerationJob.FAILED, "simulator crashed", 2))
+        self.assertEqual(self.stored_key_count(), 2)  # Only the keys of the first chunk are stored.
+
+    def test_stale_running_job_is_resumed(self):
+        job_id = self.submit(3)
+        # The process running the job stopped after its first chunk.
+        stored = store_generated_keys([b'\x00' * 8] * 2, b'k' * 16, self.master, [self.slave])
+        KeyGenerationJob.objects.filter(job_id=job_id).update(
+            status=KeyGenerationJob.RUNNING, key_ids=[key['key_ID'] for key in stored])
+        self.assertEqual(run_pending_key_jobs(), 0)  # Not stale yet.
+
+        KeyGenerationJob.objects.filter(job_id=job_id).update(
+            updated_at=timezone.now() - timedelta(seconds=settings.KEY_JOB_STALE_AFTER + 1))
+        self.assertEqual(run_pending_key_jobs(), 1)
+        job = self.poll(job_id)
+        self.assertEqual((job['status'], len(job['keys'])), (KeyGenerationJob.DONE, 3))
+        self.assertEqual(KeyMaterial.objects.count(), 3)
+        self.assertEqual(self.stored_key_count(), 3)
+
+    def test_pending_jobs_resumed_at_startup(self):
+        # A web process taking over the jobs schedules the pending ones in its background threads.
+        job_id = self.submit(1)
+        with mock.patch('api.jobs.get_job_threads', return_value=mock.Mock(submit=lambda *args: args[0]())), \
+                mock.patch('api.jobs.submit_key_job') as submit_key_job:
+            resume_key_jobs()
+        submit_key_job.assert_called_once_with(uuid.UUID(job_id))
+
+
+class KeyGenerationQueueTests(SimpleTestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        self.addCleanup(self.release.set)
+        patcher = mock.patch.object(keygen, '_executor', executor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def blocked_generation(self, *args):
+        self.release.wait(5)
+        return [], []
+
+    @override_settings(KEYGEN_QUEUE_DEPTH=1, KEYGEN_TIMEOUT=0.05)
+    def test_timed_out_generation_keeps_its_slot(self):
+        with mock.patch.object(keygen, 'generate_encrypted_keys', self.blocked_generation):
+            with self.assertRaises(asyncio.TimeoutError):
+                asyncio.run(run_key_generation(1, 8, b'k' * 16, 'link'))
+            # The generation still runs in its worker: the queue is still full.
+            with self.assertRaises(KeyGenerationBusy):
+                asyncio.run(run_key_generation(1, 8, b'k' * 16, 'link'))
+
+            self.release.set()
+            keygen._executor.submit(lambda: None).result(5)  # Wait for the blocked generation.
+        self.assertEqual(keygen._pending_jobs, 0)
+
+
+class StandInKMEHandler(BaseHTTPRequestHandler):
+    """Answers each request with the next (status, delay) of the server responses, 200 once they run out."""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append((self.path, self.headers, body))
+        status_code, delay = self.server.responses.pop(0) if self.server.responses else (200, 0)
+        time.sleep(delay)
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b'{"received": 0}')
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInKME(ThreadingHTTPServer):
+    """Local HTTP server standing in for a peer KME receiving relayed keys."""
+    daemon_threads = True
+
+    def __init__(self, responses=()):
+        super().__init__(('127.0.0.1', 0), StandInKMEHandler)
+        self.responses = list(responses)
+        self.received = []
+        self.kme = KME(name='peer', hostname=f'http://127.0.0.1:{self.server_address[1]}')
+
+    def handle_error(self, request, client_address):
+        pass  # The client hung up after a timeout.
+
+
+@override_settings(KME_RELAY_RETRIES=2, KME_RELAY_BACKOFF=0, KME_RELAY_CONNECT_TIMEOUT=1, KME_RELAY_READ_TIMEOUT=1)
+class KeyRelayTests(SimpleTestCase):
+
+    def setUp(self):
+        close_peer_sessions()  # The sessions are configured from the settings on creation.
+        self.addCleanup(close_peer_sessions)
+        self.source_kme = KME(name='source', hostname='localhost')
+
+    def start_peer(self, responses=()):
+        peer = StandInKME(responses)
+        threading.Thread(target=peer.serve_forever, daemon=True).start()
+        self.addCleanup(peer.server_close)
+        self.addCleanup(peer.shutdown)
+        return peer
+
+    def relay(self, peer):
+        batch = KeyRelayBatch(self.source_kme, {peer.kme.kme_id: RELAY_SECRET})
+        for name in ('slave 1', 'slave 2'):
+            batch.add(peer.kme, SAE(name=name, kme=peer.kme), [{"key_ID": str(uuid.uuid4())}], b'k' * 16)
+        return batch.send()
+
+    def test_coalesced_relay(self):
+        peer = self.start_peer()
+        responses = self.relay(peer)
+        self.assertEqual(responses[peer.kme.kme_id].status_code, 200)
+
+        self.assertEqual(len(peer.received), 1)
+        path, headers, body = peer.received[0]
+        self.assertEqual(path, RELAY_PATH)
+        self.assertTrue(verify_relay(RELAY_SECRET, headers, body))
+        self.assertFalse(verify_relay(b'other secret', headers, body))
+        payload = json.loads(body)
+        self.assertEqual([batch['source_KME_ID'] for batch in payload['batches']], [str(self.source_kme.kme_id)] * 2)
+
+    def test_retries_unavailable_peer(self):
+        peer = self.start_peer([(503, 0), (502, 0)])
+        self.assertEqual(self.relay(peer)[peer.kme.kme_id].status_code, 200)
+        self.assertEqual(len(peer.received), 3)
+
+    def test_gives_up_after_the_retries(self):
+        peer = self.start_peer([(503, 0)] * 5)
+        with self.assertRaises(requests.HTTPError):
+            self.relay(peer)
+        self.assertEqual(len(peer.received), 3)
+
+    def test_client_error_is_not_retried(self):
+        peer = self.start_peer([(400, 0)])
+        with self.assertRaises(requests.HTTPError):
+            self.relay(peer)
+        self.assertEqual(len(peer.received), 1)
+
+    @override_settings(KME_RELAY_RETRIES=1, KME_RELAY_READ_TIMEOUT=0.1)
+    def test_read_timeout(self):
+        peer = self.start_peer([(200, 0.5)] * 2)
+        start = time.monotonic()
+        with self.assertRaises(requests.RequestException):
+            post_to_peer(peer.kme, {"batches": []}, RELAY_SECRET)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(len(peer.received), 2)
+
+    def test_unreachable_peer(self):
+        peer = StandInKME()
+        peer.server_close()  # Nothing listens on its port any more.
+        with self.assertRaises(requests.ConnectionError):
+            post_to_peer(peer.kme, {"batches": []}, RELAY_SECRET)
+
+
+class IngestKeysTests(TestCase):
+
+    def setUp(self):
+        self.source_kme = KME.objects.create(name='source', hostname='source', certificate=b'certificate')
+        self.kme, _, self.slave = create_topology(certificate=b'certificate')
+        KMEConnection.objects.create(source_kme=self.source_kme, target_kme=self.kme, relay_secret=RELAY_SECRET)
+        self.client = APIClient()
+
+        aes_key = get_random_bytes(16)
+        self.key_id = str(uuid.uuid4())
+        encrypted_key = encrypt_keys_aes([b'\x01' * 8], aes_key)[0]
+        self.body = json.dumps({"batches": [{
+            "source_KME_ID": str(self.source_kme.kme_id),
+            "sae_slave_id": str(self.slave.sae_id),
+            "keys": [{"key_ID": self.key_id, "encrypted_key": base64.b64encode(encrypted_key).decode()}],
+            "aes_key": base64.b64encode(aes_key).decode(),
+            "mode": "CBC",
+        }]}).encode()
+
+    def ingest(self, body, headers):
+        return self.client.post('/api/v1/keys/enc_keys/', body, content_type='application/json',
+                                headers={name: value for name, value in headers.items() if name != 'Content-Type'})
+
+    def test_signed_relay(self):
+        response = self.ingest(self.body, relay_headers(RELAY_SECRET, self.body))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"received": 1})
+        self.assertTrue(KeyDelivery.objects.filter(keymaterial_id=self.key_id, sae=self.slave).exists())
+
+    def test_rejected_relays(self):
+        forged = self.body.replace(b'"CBC"', b'"GCM"')
+        for name, headers in (
+                ("unsigned", {}),
+                ("wrong secret", relay_headers(b'guessed secret', self.body)),
+                ("tampered body", {**relay_headers(RELAY_SECRET, forged), 'X-KME-Timestamp': '0'}),
+                ("other body", relay_headers(RELAY_SECRET, forged)),
+                ("expired", relay_headers(RELAY_SECRET, self.body, timestamp=int(time.time()) - 3600))):
+            with self.subTest(name):
+                self.assertEqual(self.ingest(self.body, headers).status_code, 403)
+        self.assertFalse(KeyMaterial.objects.exists())
+
+    def test_no_relay_secret(self):
+        KMEConnection.objects.update(relay_secret=None)
+        self.assertEqual(self.ingest(self.body, relay_headers(RELAY_SECRET, self.body)).status_code, 403)
+        self.assertFalse(KeyMaterial.objects.exists())
+
+
+@override_settings(BB84_ENGINE='analytic', KEY_POOL_ENABLED=False, KME_RELAY_CHUNK_SIZE=2, KME_RELAY_BACKOFF=0)
+class CrossKMEEncKeysTests(TestCase):
+
+    def setUp(self):
+        close_peer_sessions()
+        self.addCleanup(close_peer_sessions)
+        self.peer = StandInKME()
+        threading.Thread(target=self.peer.serve_forever, daemon=True).start()
+        self.addCleanup(self.peer.server_close)
+        self.addCleanup(self.peer.shutdown)
+
+        self.kme, self.master, self.local_slave = create_topology(certificate=b'certificate')
+        self.peer.kme.certificate = b'certificate'
+        self.peer.kme.save()
+        self.peer_slave = SAE.objects.create(name='peer slave', kme=self.peer.kme)
+        KMEConnection.objects.create(source_kme=self.kme, target_kme=self.peer.kme, relay_secret=RELAY_SECRET)
+
+        # The generation runs in a thread instead of the process pool.
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        patcher = mock.patch('api.pipeline.get_executor', return_value=executor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = authenticated_client()
+
+    def post_keys(self, **data):
+        return self.client.post(f'/api/v1/keys/{self.peer_slave.sae_id}/enc_keys/',
+                                {'master_sae_id': str(self.master.sae_id), 'size': 64, **data}, format='json')
+
+    def stored_key_count(self):
+        return KME.objects.get(kme_id=self.kme.kme_id).stored_key_count
+
+    def test_relayed_keys_are_purged_once_retrieved(self):
+        response = self.post_keys(number=3)
+        self.assertEqual(response.status_code, 200)
+        key_ids = [key['key_ID'] for key in response.json()['keys']]
+
+        # Two signed chunks were relayed, and only the master SAE is queued locally.
+        self.assertEqual(len(self.peer.received), 2)
+        for _, headers, body in self.peer.received:
+            self.assertTrue(verify_relay(RELAY_SECRET, headers, body))
+        self.assertEqual(set(KeyDelivery.objects.values_list('sae_id', flat=True)), {self.master.sae_id})
+        self.assertEqual(self.stored_key_count(), 3)
+
+        self.assertEqual(purge_consumed_keys(), 0)
+        response = self.client.get(f'/api/v1/keys/{self.master.sae_id}/dec_keys/', {'key_ID': key_ids})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(purge_consumed_keys(), 3)
+        self.assertEqual(self.stored_key_count(), 0)
+
+    def test_local_slaves_are_queued(self):
+        response = self.post_keys(number=1, add_slave_id=[str(self.local_slave.sae_id)])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(KeyDelivery.objects.values_list('sae_id', flat=True)),
+                         {self.master.sae_id, self.local_slave.sae_id})
+
+    def test_no_relay_secret(self):
+        KMEConnection.objects.all().delete()
+        self.assertEqual(self.post_keys(number=1).status_code, 403)
+        self.assertEqual(self.peer.received, [])
+        self.assertEqual(self.stored_key_count(), 0)
+
+    def test_unavailable_peer(self):
+        self.peer.responses = [(503, 0)] * 10
+        response = self.post_keys(number=3)
+        self.assertEqual(response.status_code, 502)
+        # The keys stored before the relay failed are deleted with their KEK and their storage released.
+        self.assertFalse(KeyMaterial.objects.exists())
+        self.assertFalse(KeyEncryptionKey.objects.exists())
+        self.assertEqual(self.stored_key_count(), 0)
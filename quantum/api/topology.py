@@ -0,0 +1,69 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import KME, SAE
+
+# In-process LRU cache of the SAE topology: sae_id -> (expiry time, SAE).
+# The cached SAEs come with their KME and their partner SAE (and its KME).
+_topology_cache = OrderedDict()
+_topology_lock = threading.Lock()
+
+
+def get_sae(sae_id, is_master=None):
+    """
+    Retrieve an SAE with its KME and the SAE it communicates with, using the topology cache.
+    Raises SAE.DoesNotExist if the SAE does not exist (or is not a master SAE when is_master is True).
+    The returned SAE is shared between requests and must not be modified outside of a save().
+    """
+    key = str(sae_id)
+    now = time.monotonic()
+
+    with _topology_lock:
+        entry = _topology_cache.get(key)
+        if entry and entry[0] > now:
+            _topology_cache.move_to_end(key)
+            sae = entry[1]
+        else:
+            sae = None
+
+    if sae is None:
+        try:
+            sae = (SAE.objects
+                   .select_related('kme', 'communicates_with', 'communicates_with__kme')
+                   .get(sae_id=sae_id))
+        except ValidationError:  # Malformed SAE ID.
+            raise SAE.DoesNotExist
+
+        with _topology_lock:
+            _topology_cache[key] = (now + settings.TOPOLOGY_CACHE_TTL, sae)
+            _topology_cache.move_to_end(key)
+            while len(_topology_cache) > settings.TOPOLOGY_CACHE_SIZE:
+                _topology_cache.popitem(last=False)
+
+    if is_master and not sae.is_master:
+        raise SAE.DoesNotExist
+    return sae
+
+
+def clear_topology_cache():
+    """Drop every cached SAE of this process."""
+    with _topology_lock:
+        _topology_cache.clear()
+
+
+@receiver(post_save, sender=SAE)
+@receiver(post_delete, sender=SAE)
+@receiver(post_save, sender=KME)
+@receiver(post_delete, sender=KME)
+def invalidate_topology_cache(sender, **kwargs):
+    """
+    Invalidate the topology cache when an SAE or a KME changes.
+    The cached SAEs embed their related SAE and KMEs, so the whole cache is dropped.
+    """
+    clear_topology_cache()
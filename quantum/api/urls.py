@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework import routers
-from .views import KMEViewSet, RegisterView, LoginView
+from .views import KMEViewSet, KeyJobViewSet, RegisterView, LoginView, AsyncKeyGenerationView, MetricsView
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
     TokenRefreshView,
@@ -9,14 +9,19 @@ from rest_framework_simplejwt.views import (
 
 router = routers.DefaultRouter()
 router.register(r'keys', KMEViewSet, basename='keys')
+router.register(r'jobs', KeyJobViewSet, basename='jobs')
 urlpatterns = [
     # registration for authentication
     path('register/', RegisterView.as_view(), name='register'),
     path('login/', LoginView.as_view(), name='login'),
 
     # route of Endpoints
+    path('keys/<str:pk>/enc_keys/async/', AsyncKeyGenerationView.as_view(), name='enc_keys_async'),
     path('', include(router.urls)),
 
+    # Monitoring
+    path('metrics/', MetricsView.as_view(), name='metrics'),
+
     # Authentication
     path('token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh')
@@ -1,6 +1,18 @@
+import asyncio
 import base64
+import hmac
+import logging
+import uuid
 
+import requests
+
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.http import HttpResponse, JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from rest_framework import generics
 from rest_framework.permissions import AllowAny
 from rest_framework.views import APIView
@@ -8,15 +20,33 @@ from rest_framework_simplejwt.views import TokenObtainPairView
 from .serializers import UserSerializer, TokenObtainPairSerializer
 
 from Crypto.Random import get_random_bytes
-from rest_framework import viewsets, status
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework import exceptions, viewsets, status
+from rest_framework.parsers import JSONParser
+from rest_framework.request import Request
+from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.decorators import action
-from .models import SAE, KME, update_sae_communication, KeyMaterial
-from .serializers import StatusSerializer
-from .bb84 import generate_bb84_keys
-from .encryptor import decrypt_key_aes
-from .service import store_generated_keys, update_kme_key_count, get_additional_slave
+from .models import SAE, KME, update_sae_communication, KeyMaterial, KeyGenerationJob
+from .serializers import StatusSerializer, KeyPoolSerializer, KeyJobSerializer
+from .encryptor import key_to_bits
+from .jobs import create_key_job
+from .kek import KEKUnwrapError
+from .keygen import run_key_generation, KeyGenerationBusy
+from .metrics import render_metrics, stage
+from .pool import take_pooled_keys, key_pool_status
+from .postprocessing import QBERTooHigh
+from .reservoir import generate_keys, link_id
+from .topology import get_sae
+from .pipeline import generate_and_relay_keys
+from .relay import get_relay_secrets, verify_relay
+from .service import (store_generated_keys, reserve_key_capacity, release_key_capacity, get_additional_slave, decrypt_key_materials,
+                      get_key_page, has_unconsumed_keys, stream_keys, claim_keys, consume_keys, encode_key,
+                      validate_certificates, ingest_relayed_keys)
+
+logger = logging.getLogger(__name__)
 
 
 class RegisterView(APIView):
@@ -38,6 +68,87 @@ class LoginView(TokenObtainPairView):
     serializer_class = TokenObtainPairSerializer
 
 
+def prepare_key_generation(request, slave_sae, relay=False):
+    """
+    Validates a key generation request (enc_keys POST) of a master SAE for a slave SAE
+    and reserves the storage of the requested keys in the KME of the master SAE.
+    Slave SAEs of other KMEs are only accepted if the keys will be relayed to them (relay).
+    Returns the generation parameters, or the Response to send if the request is rejected.
+    """
+    # Retrieve the master SAE ID from the request.
+    master_sae_id = request.data.get('master_sae_id', None)
+    if not master_sae_id:
+        return Response({"error": "Master SAE ID not provided"}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Retrieve the master SAE and the KME connected to it.
+    try:
+        master_sae = get_sae(master_sae_id, is_master=True)
+    except SAE.DoesNotExist:
+        return Response({"error": "Master SAE not found"}, status=status.HTTP_404_NOT_FOUND)
+    kme_master = master_sae.kme
+    kme_slave = slave_sae.kme
+    kme = kme_master
+
+    # Manage key generation parameters (size and number of keys), per request, within the limits
+    # of the KME reported by the status endpoint: the KME key_size is the default size.
+    number_of_keys = request.data.get('number', 1)
+    num_bits_per_key = request.data.get('size', kme.key_size)
+    if not isinstance(number_of_keys, int) or not 1 <= number_of_keys <= kme.max_key_per_request:
+        return Response({"error": f"Invalid number of keys: from 1 to {kme.max_key_per_request} keys per request"},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if not isinstance(num_bits_per_key, int) or num_bits_per_key % 8 != 0:
+        return Response({"error": "Key size must be a multiple of 8"}, status=status.HTTP_400_BAD_REQUEST)
+    if not kme.min_key_size <= num_bits_per_key <= kme.max_key_size:
+        return Response({"error": f"Invalid key size: from {kme.min_key_size} to {kme.max_key_size} bits"},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    # Add other slave SAEs if necessary.
+    add_slave_saes = get_additional_slave(request, add_slave_id='add_slave_id')
+    if isinstance(add_slave_saes, Response):
+        return add_slave_saes
+    target_saes = [slave_sae] + list(add_slave_saes)
+
+    # Connection between KMEs: the keys of the slave SAEs of other KMEs are relayed to them,
+    # so the certificates of the KMEs must match and the KMEs must share a relay secret.
+    peer_kmes = {sae.kme_id: sae.kme for sae in target_saes if sae.kme_id != kme_master.kme_id}
+    relay_secrets = {}
+    if peer_kmes:
+        if not relay:
+            return Response({"error": "Key generation between different KMEs is not supported in this mode"},
+                            status=status.HTTP_501_NOT_IMPLEMENTED)
+        if not all(validate_certificates(kme_master, peer_kme) for peer_kme in peer_kmes.values()):
+            return Response({"error": "Invalid certificates between the KMEs"}, status=status.HTTP_403_FORBIDDEN)
+        relay_secrets = get_relay_secrets(kme_master, peer_kmes.values())
+        if len(relay_secrets) < len(peer_kmes):
+            return Response({"error": "No relay secret shared with the slave KME"}, status=status.HTTP_403_FORBIDDEN)
+
+    # Reserve the storage of the keys in the KME before generating them.
+    try:
+        with stage('count_update'):
+            reserve_key_capacity(kme, number_of_keys)
+    except ValueError as value:
+        return Response({"error": str(value)}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Update the communication relationships between the master and the slave,
+    # once the request is accepted.
+    try:
+        with stage('communication'):
+            update_sae_communication(master_sae, slave_sae)
+    except Exception:
+        release_key_capacity(kme, number_of_keys)
+        raise
+
+    return {
+        "master_sae": master_sae,
+        "kme": kme,
+        "kme_slave": kme_slave,
+        "number": number_of_keys,
+        "size": num_bits_per_key,
+        "target_saes": target_saes,
+        "relay_secrets": relay_secrets,  # kme_id -> relay secret, for the KMEs of the slave SAEs to relay to.
+    }
+
+
 class KMEViewSet(viewsets.ViewSet):
     """
    ViewSet to handle requests related to KME.
@@ -56,7 +167,7 @@ class KMEViewSet(viewsets.ViewSet):
 
         # Retrieve the slave SAE via its ID (pk).
         try:
-            slave_sae = SAE.objects.get(sae_id=pk)
+            slave_sae = get_sae(pk)
         except SAE.DoesNotExist:
             return Response({"error": "SAE not found"}, status=404)
 
@@ -69,8 +180,9 @@ class KMEViewSet(viewsets.ViewSet):
         if not master_sae:
             return Response({"error": "No master SAE found for this KME"}, status=404)
 
-        # Retrieve the KME of the master SAE.
+        # Retrieve the KME of the master SAE, with its current number of stored keys.
         target_kme = master_sae.kme
+        stored_key_count = KME.objects.values_list('stored_key_count', flat=True).get(kme_id=target_kme.kme_id)
 
         # Create the response dictionary according to the ETSI specification.
         status_data = {
@@ -79,7 +191,7 @@ class KMEViewSet(viewsets.ViewSet):
             "master_SAE_ID": master_sae.sae_id,
             "slave_SAE_ID": slave_sae.sae_id,
             "key_size": target_kme.key_size,
-            "stored_key_count": target_kme.stored_key_count,
+            "stored_key_count": stored_key_count,
             "max_key_count": target_kme.max_key_count,
             "max_key_per_request": target_kme.max_key_per_request,
             "max_key_size": target_kme.max_key_size,
@@ -91,124 +203,354 @@ class KMEViewSet(viewsets.ViewSet):
         serializer = StatusSerializer(status_data)
         return Response(serializer.data, status=200)
 
+    @action(detail=True, methods=['get'], url_path='pool')
+    def get_pool_status(self, request, pk=None):
+        """
+        Endpoint to retrieve the fill level and counters of the key pool of the KME of a slave SAE.
+        https://{KME_hostname}/api/v1/keys/{slave_SAE_ID}/pool
+        """
+        try:
+            slave_sae = get_sae(pk)
+        except SAE.DoesNotExist:
+            return Response({"error": "SAE not found"}, status=404)
+
+        serializer = KeyPoolSerializer(key_pool_status(slave_sae.kme))
+        return Response(serializer.data, status=200)
+
     @action(detail=True, methods=['post', 'get'], url_path='enc_keys')
     def get_key(self, request, pk=None):
         """
         Endpoint to generate or retrieve keys (enc_keys).
-        POST : Generate keys (used by the master SAE).
-        GET : Retrieve the generated keys (used by the slave SAE).
+        POST : Generate keys (used by the master SAE), or submit a key generation job with "async": true.
+        GET : Retrieve the generated keys (used by the slave SAE), or consume the next `number` keys.
         https://{KME_hostname}/api/v1/keys/{slave_SAE_ID}/enc_keys
         """
 
         # Retrieve the slave SAE.
         try:
-            slave_sae = SAE.objects.get(sae_id=pk)
-            kme_slave = KME.objects.get(kme_id=slave_sae.kme_id)
-        except (SAE.DoesNotExist, KME.DoesNotExist):
+            slave_sae = get_sae(pk)
+            kme_slave = slave_sae.kme
+        except SAE.DoesNotExist:
             return Response({"error": "Slave SAE or KME not found"}, status=status.HTTP_404_NOT_FOUND)
 
         if request.method == 'POST':
             # POST: The master SAE generates the keys.
+            asynchronous = request.data.get('async') is True
+            key_request = prepare_key_generation(request, slave_sae, relay=not asynchronous)
+            if isinstance(key_request, Response):
+                return key_request
+
+            # Asynchronous mode: return a job ID right away and generate the keys in the background.
+            if asynchronous:
+                job = create_key_job(key_request)
+                return Response({"job_ID": str(job.job_id)}, status=status.HTTP_202_ACCEPTED)
+
+            # Connection between KMEs: generate, store and relay the keys as a pipeline.
+            if key_request['relay_secrets']:
+                try:
+                    stored_keys = generate_and_relay_keys(key_request)
+                except requests.RequestException as error:
+                    return Response({"error": f"Relay to the slave KME failed: {error}"},
+                                    status=status.HTTP_502_BAD_GATEWAY)
+                except QBERTooHigh as error:
+                    return Response({"error": f"Key generation aborted: {error}"},
+                                    status=status.HTTP_503_SERVICE_UNAVAILABLE)
+                return Response({"keys": stored_keys}, status=status.HTTP_200_OK)
 
-            # Retrieve the master SAE ID from the request.
-            master_sae_id = request.data.get('master_sae_id', None)
-            if not master_sae_id:
-                return Response({"error": "Master SAE ID not provided"}, status=status.HTTP_400_BAD_REQUEST)
-
-            # Retrieve the master SAE.
-            try:
-                master_sae = SAE.objects.get(sae_id=master_sae_id, is_master=True)
-            except SAE.DoesNotExist:
-                return Response({"error": "Master SAE not found"}, status=status.HTTP_404_NOT_FOUND)
-
-            # Retrieve the KME connected to the master SAE.
+            kme = key_request['kme']
+            number_of_keys = key_request['number']
+            num_bits_per_key = key_request['size']
             try:
-                kme_master = KME.objects.get(kme_id=master_sae.kme_id)
-            except KME.DoesNotExist:
-                return Response({"error": "KME not found for the Master SAE"}, status=status.HTTP_404_NOT_FOUND)
-
-            # Connection on the same KME
-            if kme_slave.kme_id == kme_master.kme_id:
-                kme = kme_master
-                # Update the communication relationships between the master and the slave.
-                update_sae_communication(master_sae, slave_sae)
-
-                # Manage key generation parameters (size and number of keys).
-                number_of_keys = request.data.get('number', 1)
-                num_bits_per_key = request.data.get('size', 16)
-
-                kme.key_size = num_bits_per_key
-                kme.save(update_fields=['key_size'])
-
-                # Generate the BB84 keys.
-                bb84_keys = generate_bb84_keys(num_keys=number_of_keys, num_bits_per_key=num_bits_per_key)
+                # Take the keys from the pre-generated pool if it can serve the request.
+                bb84_keys = None
+                if settings.KEY_POOL_ENABLED:
+                    with stage('pool'):
+                        bb84_keys = take_pooled_keys(kme, number_of_keys, num_bits_per_key)
+
+                # Otherwise generate the BB84 keys with the engine configured in BB84_ENGINE.
+                if bb84_keys is None:
+                    with stage('bb84'):
+                        bb84_keys = generate_keys(link_id(kme, key_request['kme_slave']), number_of_keys,
+                                                  num_bits_per_key)
 
                 # Hash the AES key for encryption.
                 aes_key = get_random_bytes(16)
 
-                # Add other slave SAEs if necessary.
-                add_slave_saes = get_additional_slave(request, add_slave_id='add_slave_id')
-                all_sae = [slave_sae] + add_slave_saes
-
                 # Encrypt and store each key in the database.
-                stored_keys = store_generated_keys(bb84_keys, aes_key, master_sae, all_sae)
-
-                # Update the number of stored keys in the KME.
-                try:
-                    update_kme_key_count(kme, number_of_keys)
-                except ValueError as value:
-                    return Response({"error": str(value)}, status=status.HTTP_400_BAD_REQUEST)
-
-                # Return the response with the generated keys.
-                return Response({"keys": stored_keys}, status=status.HTTP_200_OK)
+                stored_keys = store_generated_keys(bb84_keys, aes_key, key_request['master_sae'],
+                                                   key_request['target_saes'])
+            except KEKUnwrapError as error:
+                # The pooled keys cannot be decrypted with the configured master key.
+                release_key_capacity(kme, number_of_keys)
+                logger.error("%s", error)
+                return Response({"error": "The pooled keys cannot be decrypted: the key-encryption master key "
+                                          "(KEK_MASTER_KEY) has changed"},
+                                status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            except QBERTooHigh as error:
+                # The channel is too noisy or eavesdropped: no key can be generated for now.
+                release_key_capacity(kme, number_of_keys)
+                return Response({"error": f"Key generation aborted: {error}"},
+                                status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            except ValueError as value:
+                release_key_capacity(kme, number_of_keys)
+                return Response({"error": str(value)}, status=status.HTTP_400_BAD_REQUEST)
+            except Exception:
+                release_key_capacity(kme, number_of_keys)
+                raise
+
+            # Return the response with the generated keys.
+            return Response({"keys": stored_keys}, status=status.HTTP_200_OK)
 
         elif request.method == 'GET':
             # GET: slave SAE retrieves the generated keys
 
-            # Retrieve the encrypted keys associated with this slave SAE.
-            keys = KeyMaterial.objects.filter(consult_by=slave_sae)
+            # Claim the next `number` keys of the queue of this slave SAE (number=N, at most KEY_PAGE_SIZE_MAX).
+            if 'number' in request.query_params:
+                try:
+                    number = int(request.query_params['number'])
+                except ValueError:
+                    number = 0
+                if not 1 <= number <= settings.KEY_PAGE_SIZE_MAX:
+                    return Response({"error": "Invalid number of keys"}, status=status.HTTP_400_BAD_REQUEST)
+
+                keys = claim_keys(slave_sae, number)
+                if not keys:
+                    return Response({"error": "No keys found for this Slave SAE"}, status=status.HTTP_404_NOT_FOUND)
+
+                key_data = [encode_key(key) for key in keys]
+                return Response({"keys": key_data}, status=status.HTTP_200_OK)
+
+            # Stream every unconsumed key shared with this slave SAE (stream=true).
+            if request.query_params.get('stream') == 'true':
+                if not has_unconsumed_keys(slave_sae):
+                    return Response({"error": "No keys found for this Slave SAE"}, status=status.HTTP_404_NOT_FOUND)
+                return StreamingHttpResponse(stream_keys(slave_sae), content_type='application/json')
+
+            # Otherwise return one page of keys, starting after the given cursor.
+            cursor = request.query_params.get('cursor')
+            try:
+                page_size = int(request.query_params.get('page_size', settings.KEY_PAGE_SIZE))
+                keys, next_cursor = get_key_page(slave_sae, cursor, page_size)
+            except ValueError:
+                return Response({"error": "Invalid cursor or page size"}, status=status.HTTP_400_BAD_REQUEST)
 
-            if not keys.exists():
+            if not keys and not cursor:
                 return Response({"error": "No keys found for this Slave SAE"}, status=status.HTTP_404_NOT_FOUND)
 
             # Prepare the response with the encrypted keys.
-            key_data = [{"key_ID": str(key.key_id), "key": key.encrypted_key} for key in keys]
+            key_data = [encode_key(key) for key in keys]
 
-            return Response({"keys": key_data}, status=status.HTTP_200_OK)
+            return Response({"keys": key_data, "next_cursor": next_cursor}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['post'], url_path='enc_keys', authentication_classes=[],
+            permission_classes=[AllowAny])
+    def ingest_keys(self, request):
+        """
+        Endpoint receiving the keys relayed by a peer KME for its local slave SAEs.
+        The peer is authenticated by the signature of the request with the relay secret of the
+        connection between the two KMEs (X-KME-Signature and X-KME-Timestamp headers, see api.relay).
+        https://{KME_hostname}/api/v1/keys/enc_keys
+        """
+        body = request.body  # The signed body, read before it is parsed.
+
+        # A single relay payload, or several coalesced ones (all from the same source KME).
+        try:
+            payloads = request.data.get('batches', [request.data])
+            source_kme = KME.objects.get(kme_id=payloads[0].get('source_KME_ID'))
+        except (KME.DoesNotExist, ValidationError, AttributeError, IndexError, KeyError, TypeError):
+            return Response({"error": "Source KME not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            # Authenticate the relay for the KMEs of all the slave SAEs before storing any key.
+            slave_saes = []
+            verified_kmes = set()
+            for payload in payloads:
+                if payload.get('source_KME_ID') != str(source_kme.kme_id):
+                    return Response({"error": "Mixed source KMEs"}, status=status.HTTP_400_BAD_REQUEST)
+
+                slave_sae = get_sae(payload.get('sae_slave_id'))
+                if slave_sae.kme_id not in verified_kmes:
+                    secret = get_relay_secrets(source_kme, [slave_sae.kme]).get(slave_sae.kme_id)
+                    if not verify_relay(secret, request.headers, body):
+                        return Response({"error": "Invalid relay signature"}, status=status.HTTP_403_FORBIDDEN)
+                    if not validate_certificates(source_kme, slave_sae.kme):
+                        return Response({"error": "Invalid certificates between the KMEs"},
+                                        status=status.HTTP_403_FORBIDDEN)
+                    verified_kmes.add(slave_sae.kme_id)
+                slave_saes.append(slave_sae)
+
+            received = 0
+            for slave_sae, payload in zip(slave_saes, payloads):
+                received += ingest_relayed_keys(slave_sae, payload)
+        except SAE.DoesNotExist:
+            return Response({"error": "Slave SAE not found"}, status=status.HTTP_404_NOT_FOUND)
+        except (AttributeError, KeyError, TypeError, ValueError) as error:
+            return Response({"error": f"Invalid relayed keys: {error}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({"received": received}, status=status.HTTP_200_OK)
 
     @action(detail=True, methods=['get', 'post'], url_path='dec_keys')
     def get_keys_by_ids(self, request, pk=None):
         """
         Endpoint to retrieve specific keys with their key_IDs for a slave SAE.
-        https://{KME_hostname}/api/v1/keys/{master_SAE_ID}/dec_keys?key_ID=bc490419-7d60-487f-adc1-4ddcc177c139
+        GET : https://{KME_hostname}/api/v1/keys/{master_SAE_ID}/dec_keys?key_ID=bc490419-7d60-487f-adc1-4ddcc177c139
+              (the key_ID parameter may be repeated).
+        POST : {"key_IDs": [{"key_ID": "bc490419-7d60-487f-adc1-4ddcc177c139"}, ...]} (ETSI format).
+        The keys are returned base64 encoded (ETSI format), or as lists of bits with key_format=bits
+        (the format parameter is reserved by DRF to select the renderer).
         """
         # Retrieve the master SAE via the ID passed in the URL.
         try:
-            master_sae = SAE.objects.get(sae_id=pk, is_master=True)
-            print(f"master id: {master_sae}")
+            master_sae = get_sae(pk, is_master=True)
         except SAE.DoesNotExist:
             return Response({"error": "Master SAE not found"}, status=status.HTTP_404_NOT_FOUND)
 
-        # Retrieve the key_IDs from the GET request parameters.
-        key_ids = request.query_params.get('key_ID')
+        # Retrieve the key_IDs from the GET parameters or the POST body.
+        if request.method == 'POST':
+            key_ids = [
+                key_id.get('key_ID') if isinstance(key_id, dict) else key_id
+                for key_id in request.data.get('key_IDs', [])
+            ]
+        else:
+            key_ids = request.query_params.getlist('key_ID')
 
         if not key_ids:
             return Response({"error": "No key IDs provided"}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Retrieve the keys associated with the provided key_IDs.
-        keys = KeyMaterial.objects.filter(key_id=key_ids)
+        try:
+            key_ids = [uuid.UUID(str(key_id)) for key_id in key_ids]
+        except ValueError:
+            return Response({"error": "Invalid key ID"}, status=status.HTTP_400_BAD_REQUEST)
 
-        if not keys.exists():
+        # Retrieve all the keys associated with the provided key_IDs in a single query.
+        keys = list(KeyMaterial.objects.filter(key_id__in=key_ids))
+
+        if not keys:
             return Response({"error": "No keys found for the provided key IDs"}, status=status.HTTP_404_NOT_FOUND)
 
+        # The legacy list-of-bits format is only returned on request (key_format=bits).
+        legacy_format = request.query_params.get('key_format') == 'bits'
+
+        # Decrypt the keys in batches. A KEK that cannot be unwrapped is a server configuration error.
+        try:
+            decrypted_keys = decrypt_key_materials(keys)
+        except KEKUnwrapError as error:
+            logger.error("%s", error)
+            return Response({"error": "The stored keys cannot be decrypted: the key-encryption master key "
+                                      "(KEK_MASTER_KEY) has changed"},
+                            status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
         # Prepare the response with the decrypted keys.
         keys_data = []
-        for key_material in keys:
-            aes_key = base64.b64decode(key_material.aes_key)
-            decrypted_key = decrypt_key_aes(key_material.encrypted_key, aes_key)
-            keys_data.append({
-                "key_ID": str(key_material.key_id),
-                "decrpyted_key": decrypted_key,
-            })
+        for key_material, decrypted_key in zip(keys, decrypted_keys):
+            if legacy_format:
+                keys_data.append({
+                    "key_ID": str(key_material.key_id),
+                    "decrpyted_key": key_to_bits(decrypted_key, key_material.size),
+                })
+            else:
+                keys_data.append({
+                    "key_ID": str(key_material.key_id),
+                    "key": base64.b64encode(decrypted_key).decode('utf-8'),
+                })
+
+        # The keys are delivered in plaintext: they may be purged once every queue entry is consumed
+        # (keys relayed to SAEs of other KMEs are queued for the master SAE: its entries are consumed now).
+        consume_keys(master_sae, [key_material.key_id for key_material in keys])
 
         return Response({"keys": keys_data}, status=status.HTTP_200_OK)
+
+
+class KeyJobViewSet(viewsets.ViewSet):
+    """
+    ViewSet to follow the asynchronous key generation jobs.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def retrieve(self, request, pk=None):
+        """
+        Endpoint to retrieve the status, the progress and the stored key IDs of a key generation job.
+        https://{KME_hostname}/api/v1/jobs/{job_ID}
+        """
+        try:
+            job = KeyGenerationJob.objects.get(job_id=pk)
+        except (KeyGenerationJob.DoesNotExist, ValidationError):
+            return Response({"error": "Job not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        serializer = KeyJobSerializer(job)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncKeyGenerationView(View):
+    """
+    Asynchronous variant of the enc_keys POST for ASGI servers: the BB84 simulation and the
+    AES encryption run in the key generation process pool, so the event loop keeps serving
+    the other requests (status, dec_keys, ...) in the meantime.
+    https://{KME_hostname}/api/v1/keys/{slave_SAE_ID}/enc_keys/async
+    """
+
+    async def post(self, request, pk=None):
+        request = Request(request, parsers=[JSONParser()], authenticators=[JWTAuthentication()])
+        key_request = await sync_to_async(self.prepare)(request, pk)
+        if isinstance(key_request, Response):
+            return JsonResponse(key_request.data, status=key_request.status_code)
+
+        kme = key_request['kme']
+        number_of_keys = key_request['number']
+        aes_key = get_random_bytes(16)
+        try:
+            with stage('generation'):  # BB84 and encryption, in the process pool.
+                bb84_keys, encrypted_keys = await run_key_generation(number_of_keys, key_request['size'], aes_key,
+                                                                     link_id(kme, key_request['kme_slave']))
+            stored_keys = await sync_to_async(store_generated_keys)(
+                bb84_keys, aes_key, key_request['master_sae'], key_request['target_saes'], encrypted_keys
+            )
+        except KeyGenerationBusy as busy:
+            await sync_to_async(release_key_capacity)(kme, number_of_keys)
+            return JsonResponse({"error": str(busy)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except asyncio.TimeoutError:
+            await sync_to_async(release_key_capacity)(kme, number_of_keys)
+            return JsonResponse({"error": "Key generation timed out"}, status=status.HTTP_504_GATEWAY_TIMEOUT)
+        except QBERTooHigh as error:
+            await sync_to_async(release_key_capacity)(kme, number_of_keys)
+            return JsonResponse({"error": f"Key generation aborted: {error}"},
+                                status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except ValueError as value:
+            await sync_to_async(release_key_capacity)(kme, number_of_keys)
+            return JsonResponse({"error": str(value)}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception:
+            await sync_to_async(release_key_capacity)(kme, number_of_keys)
+            raise
+
+        return JsonResponse({"keys": stored_keys}, status=status.HTTP_200_OK)
+
+    @staticmethod
+    def prepare(request, pk):
+        """Authenticates the request and validates it like the synchronous enc_keys POST."""
+        try:
+            if not request.user or not request.user.is_authenticated:
+                raise exceptions.NotAuthenticated()
+            slave_sae = get_sae(pk)
+        except exceptions.APIException as error:
+            return Response({"error": str(error.detail)}, status=error.status_code)
+        except SAE.DoesNotExist:
+            return Response({"error": "Slave SAE or KME not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        return prepare_key_generation(request, slave_sae)
+
+
+class MetricsView(View):
+    """
+    Metrics of this process (stage durations, request durations and database queries), in the Prometheus text format.
+    The scraper authenticates with the header "Authorization: Bearer <METRICS_TOKEN>".
+    https://{KME_hostname}/api/v1/metrics
+    """
+
+    def get(self, request):
+        if not settings.METRICS_ENABLED:
+            return JsonResponse({"error": "Metrics are disabled"}, status=status.HTTP_404_NOT_FOUND)
+        token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if not settings.METRICS_TOKEN or not hmac.compare_digest(token.encode(), settings.METRICS_TOKEN.encode()):
+            return JsonResponse({"error": "Invalid metrics token"}, status=status.HTTP_401_UNAUTHORIZED)
+        return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
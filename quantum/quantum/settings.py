@@ -9,6 +9,8 @@ https://docs.djangoproject.com/en/5.1/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
+import base64
+import hashlib
 import os
 from pathlib import Path
 from datetime import timedelta
@@ -50,6 +52,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'api.metrics.MetricsMiddleware',
 ]
 
 ROOT_URLCONF = 'quantum.urls'
@@ -91,12 +94,178 @@ SIMPLE_JWT = {
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# The backend is selected with DB_ENGINE: 'sqlite' (default, local development and tests)
+# or 'postgresql' (production, several SAEs writing keys concurrently).
+# SQLite runs in WAL mode so readers do not block the writer, and opens its write
+# transactions immediately instead of failing to upgrade a read lock. Its database file
+# (DB_NAME, db.sqlite3 by default) is created by `manage.py migrate` and is not versioned.
+# PostgreSQL keeps its connections open (DB_CONN_MAX_AGE) or, with DB_POOL=1,
+# uses the psycopg connection pool (requires psycopg[pool]).
+
+DB_ENGINE = os.environ.get('DB_ENGINE', 'sqlite')
+
+if DB_ENGINE == 'postgresql':
+    DB_POOL = os.environ.get('DB_POOL', '0') == '1'
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DB_NAME', 'quantum'),
+            'USER': os.environ.get('DB_USER', 'quantum'),
+            'PASSWORD': os.environ.get('DB_PASSWORD', ''),
+            'HOST': os.environ.get('DB_HOST', 'localhost'),
+            'PORT': os.environ.get('DB_PORT', '5432'),
+            # Persistent connections cannot be combined with the connection pool.
+            'CONN_MAX_AGE': 0 if DB_POOL else int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.environ.get('DB_POOL_MIN_SIZE', 2)),
+                    'max_size': int(os.environ.get('DB_POOL_MAX_SIZE', 20)),
+                },
+            } if DB_POOL else {},
+        }
     }
-}
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'OPTIONS': {
+                'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;',
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': 20,  # Seconds to wait for the write lock.
+            },
+        }
+    }
+
+
+# BB84 key generation
+# 'qiskit' simulates one circuit per key on the Aer qasm_simulator,
+# 'qiskit_batched' transpiles and runs all circuits of a request as one Aer job,
+# 'qiskit_chunked' does the same with circuits of at most BB84_CHUNK_QUBITS qubits,
+# 'analytic' sifts the whole batch with NumPy (ideal noiseless channel).
+
+BB84_ENGINE = os.environ.get('BB84_ENGINE', 'qiskit')
+BB84_CHUNK_QUBITS = int(os.environ.get('BB84_CHUNK_QUBITS', 16))
+
+# Qiskit and Aer are only imported by the processes running a qiskit engine, on first use.
+# With BB84_PRELOAD the key generation workers are started with the server and load the
+# engine (imports, simulator, transpiler) before their first job.
+
+BB84_PRELOAD = os.environ.get('BB84_PRELOAD', 'False') == 'True'
+
+# Deliver keys of exactly the requested size, sliced from a per-link reservoir of sifted bits,
+# instead of the sifted keys of the engines (about half of the requested size). The reservoir
+# sends raw qubits with independent bases for Alice and Bob with the selected engine and keeps
+# the bits whose bases match.
+
+BB84_EXACT_KEYS = os.environ.get('BB84_EXACT_KEYS', 'True') == 'True'
+
+# Post-processing of the sifted bits of the exact keys, in blocks of BB84_PA_BLOCK_BITS bits:
+# the QBER is estimated on a sacrificed sample (BB84_QBER_SAMPLE of each block) and the
+# generation is aborted above BB84_QBER_THRESHOLD, then the rest of the block is compressed
+# by Toeplitz hashing to its secure length minus BB84_PA_SECURITY_BITS.
+
+BB84_POSTPROCESSING = os.environ.get('BB84_POSTPROCESSING', 'False') == 'True'
+BB84_PA_BLOCK_BITS = int(os.environ.get('BB84_PA_BLOCK_BITS', 4096))
+BB84_QBER_SAMPLE = float(os.environ.get('BB84_QBER_SAMPLE', 0.1))
+BB84_QBER_THRESHOLD = float(os.environ.get('BB84_QBER_THRESHOLD', 0.11))
+BB84_PA_SECURITY_BITS = int(os.environ.get('BB84_PA_SECURITY_BITS', 64))
+
+# Noise of the quantum channel simulated by the qiskit engines: BB84_NOISE_DEPOLARIZING is the
+# probability that a qubit is depolarized before Bob measures it (a QBER of half of it), and
+# BB84_NOISE_READOUT the probability that Bob reads the flipped bit. 0 and 0 is a noiseless channel.
+
+BB84_NOISE_DEPOLARIZING = float(os.environ.get('BB84_NOISE_DEPOLARIZING', 0))
+BB84_NOISE_READOUT = float(os.environ.get('BB84_NOISE_READOUT', 0))
+
+# Process pool of the asynchronous enc_keys endpoint (ASGI): number of worker
+# processes, maximum number of queued or running generations, timeout in seconds.
+
+KEYGEN_POOL_SIZE = int(os.environ.get('KEYGEN_POOL_SIZE', 2))
+KEYGEN_QUEUE_DEPTH = int(os.environ.get('KEYGEN_QUEUE_DEPTH', 16))
+KEYGEN_TIMEOUT = int(os.environ.get('KEYGEN_TIMEOUT', 300))
+
+# Asynchronous key generation jobs (enc_keys POST with "async": true): they run
+# in KEY_JOB_THREADS background threads of the web process if KEY_JOBS_IN_PROCESS,
+# otherwise in `manage.py run_key_jobs`; keys are generated KEY_JOB_CHUNK_SIZE at a time.
+# The jobs are stored in the database: a web process takes over the pending jobs when it starts,
+# and a running job not updated for KEY_JOB_STALE_AFTER seconds (its process stopped) is re-queued.
+
+KEY_JOBS_IN_PROCESS = os.environ.get('KEY_JOBS_IN_PROCESS', 'True') == 'True'
+KEY_JOB_THREADS = int(os.environ.get('KEY_JOB_THREADS', 2))
+KEY_JOB_CHUNK_SIZE = 16
+KEY_JOB_STALE_AFTER = int(os.environ.get('KEY_JOB_STALE_AFTER', 2 * KEYGEN_TIMEOUT))
+
+# AES mode used to encrypt the stored keys: 'CBC' (IV stored with each key)
+# or 'GCM' (authenticated, nonce and tag stored with each key).
+
+KEY_ENCRYPTION_MODE = os.environ.get('KEY_ENCRYPTION_MODE', 'CBC')
+
+# In-process cache of the SAE/KME topology (number of SAEs, time to live in seconds).
+# It is invalidated on SAE/KME saves in the same process, other processes rely on the TTL.
+
+TOPOLOGY_CACHE_SIZE = 1024
+TOPOLOGY_CACHE_TTL = 60
+
+# Master key wrapping the key-encryption keys (KEKs) stored in the database, in base64
+# (16, 24 or 32 bytes). It is required when DEBUG is off. In development only, a key derived
+# from SECRET_KEY is used when it is not set: the stored keys are then lost if SECRET_KEY changes.
+
+KEK_MASTER_KEY = os.environ.get('KEK_MASTER_KEY', '')
+if not KEK_MASTER_KEY and DEBUG:
+    KEK_MASTER_KEY = base64.b64encode(hashlib.sha256(SECRET_KEY.encode()).digest()).decode()
+
+# In-process cache of the unwrapped KEKs (number of KEKs, time to live in seconds).
+
+KEK_CACHE_SIZE = 1024
+KEK_CACHE_TTL = 300
+
+# Metrics of the requests and of the key generation stages, recorded with METRICS_ENABLED and
+# exposed in the Prometheus text format on /api/v1/metrics/ to the requests authenticated with
+# the header "Authorization: Bearer <METRICS_TOKEN>". Requests slower than SLOW_REQUEST_THRESHOLD
+# seconds are logged with their stage breakdown (0 disables the log). The metrics middleware
+# is only used if the metrics or the log are enabled.
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'False') == 'True'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+SLOW_REQUEST_THRESHOLD = float(os.environ.get('SLOW_REQUEST_THRESHOLD', 1.0))
+
+# Number of keys per page of the enc_keys GET endpoint (page_size parameter).
+
+KEY_PAGE_SIZE = 100
+KEY_PAGE_SIZE_MAX = 1000
+
+# Pre-generated key pool per KME, refilled by `manage.py refill_key_pool`.
+# The pool only serves the requests whose size is one of KEY_POOL_KEY_SIZES (comma-separated
+# sizes in bits, the KME key size by default); the other requests generate their keys.
+# It holds at most KEY_POOL_MAX_BITS bits of keys, shared equally between the sizes, and each
+# size is refilled up to the high watermark once it drops below the low watermark.
+
+KEY_POOL_ENABLED = os.environ.get('KEY_POOL_ENABLED', 'False') == 'True'
+KEY_POOL_KEY_SIZES = [int(size) for size in os.environ.get('KEY_POOL_KEY_SIZES', '').split(',') if size]
+KEY_POOL_MAX_BITS = int(os.environ.get('KEY_POOL_MAX_BITS', 1024 * 1024))
+KEY_POOL_LOW_WATERMARK = 0.25
+KEY_POOL_HIGH_WATERMARK = 0.9
+
+
+# Relay of keys to peer KMEs: connections kept alive per peer, timeouts in
+# seconds, retries with exponential backoff on connection errors and 502/503/504.
+
+KME_RELAY_POOL_SIZE = 10
+KME_RELAY_CONNECT_TIMEOUT = 3.05
+KME_RELAY_READ_TIMEOUT = 30
+KME_RELAY_RETRIES = 3
+KME_RELAY_BACKOFF = 0.5
+
+# The relayed keys are signed with the relay secret of the KMEConnection between the two
+# KMEs, configured on both. Signatures are valid for KME_RELAY_SIGNATURE_MAX_AGE seconds.
+
+KME_RELAY_SIGNATURE_MAX_AGE = 300
+
+# Number of keys generated, stored and relayed together by the cross-KME pipeline.
+
+KME_RELAY_CHUNK_SIZE = 16
 
 
 # Password validation
@@ -14,3 +14,15 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'quantum.settings')
 
 application = get_wsgi_application()
+
+# Optionally start the key generation workers with the BB84 engine loaded, instead of on the first request.
+from django.conf import settings  # noqa: E402
+
+if settings.BB84_PRELOAD:
+    from api.keygen import preload_workers
+    preload_workers()
+
+# Take over the asynchronous key generation jobs left by the stopped processes.
+if settings.KEY_JOBS_IN_PROCESS:
+    from api.jobs import resume_key_jobs
+    resume_key_jobs()